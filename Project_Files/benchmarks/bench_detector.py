@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'threat_detector'))
+
+import threat_detector
+from threat_detector import BulkWriter, ThreatDetector
+from corpus import generate_corpus
+from stub_es import StubElasticsearch
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'threat_detector', 'config.yaml')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def timed_pass(func, items, logs_per_item):
+    latencies = []
+    started = time.perf_counter()
+    for item in items:
+        begin = time.perf_counter_ns()
+        func(item)
+        latencies.append((time.perf_counter_ns() - begin) / logs_per_item(item) / 1000)
+    return time.perf_counter() - started, latencies
+
+
+def peak_memory(func, items):
+    tracemalloc.start()
+    try:
+        for item in items:
+            func(item)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmark(setup, items, logs_per_item=lambda item: 1):
+    # Timing and memory are measured on separate passes, each with a freshly built detector, since
+    # tracemalloc slows allocation down enough to distort latencies
+    elapsed, latencies = timed_pass(setup(), items, logs_per_item)
+    logs = sum(logs_per_item(item) for item in items)
+    return {
+        "logs": logs,
+        "seconds": round(elapsed, 3),
+        "logs_per_second": round(logs / elapsed, 1),
+        "p50_us": round(percentile(latencies, 0.5), 2),
+        "p99_us": round(percentile(latencies, 0.99), 2),
+        "peak_memory_kib": round(peak_memory(setup(), items) / 1024, 1),
+    }
+
+
+def compare(results, baseline):
+    changes = {}
+    for name, result in results.items():
+        previous = baseline.get('benchmarks', {}).get(name)
+        if not previous:
+            continue
+        changes[name] = {
+            metric: round((result[metric] - previous[metric]) / previous[metric] * 100, 1)
+            for metric in ("logs_per_second", "p50_us", "p99_us", "peak_memory_kib") if previous.get(metric)
+        }
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure detector throughput, latency and memory on a synthetic corpus")
+    parser.add_argument('--config', default=CONFIG_PATH)
+    parser.add_argument('--logs', type=int, default=20000)
+    parser.add_argument('--attack-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch-size', type=int, help="logs per process_logs_batch call (default: processing.batch_size)")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="results file from an earlier run to report percentage changes against")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+    batch_size = args.batch_size or config['processing']['batch_size']
+    hits = generate_corpus(args.logs, args.attack_ratio, args.seed)
+    sources = [hit['_source'] for hit in hits]
+    batches = [hits[index:index + batch_size] for index in range(0, len(hits), batch_size)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Threat records go through the same queue listeners as in the service, into a scratch file
+        threat_detector.setup_logging(dict(config, logging=dict(
+            config.get('logging', {}), level='WARNING', threat_log=os.path.join(directory, 'detected_threats.log'))))
+        bulk = dict(config.get('bulk', {}), retry_queue=os.path.join(directory, 'bulk_retry_queue.jsonl'),
+                    dead_letter_file=os.path.join(directory, 'bulk_dead_letter.jsonl'))
+
+        def detector():
+            instance = ThreatDetector.for_detection(yaml.safe_load(yaml.safe_dump(config)))
+            instance.compile_field_layout()
+            instance.es = StubElasticsearch()
+            instance.bulk_writer = BulkWriter(bulk)
+            return instance
+
+        results = {
+            "detect_threats": run_benchmark(lambda: detector().detect_threats, sources),
+            "reorder_log_fields": run_benchmark(lambda: detector().reorder_log_fields, sources),
+            "process_logs_batch": run_benchmark(lambda: detector().process_logs_batch, batches, len),
+        }
+        results["process_logs_batch"]["batch_size"] = batch_size
+
+        # A change in these counts means the rules classify the corpus differently
+        counting = detector()
+        detected = Counter(threat for source in sources for threat in counting.detect_threats(source))
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "corpus": {
+            "logs": len(hits),
+            "attack_ratio": args.attack_ratio,
+            "seed": args.seed,
+            "labels": dict(Counter(source.get('threat_type', 'normal') for source in sources)),
+        },
+        "benchmarks": results,
+        "detected_threats": dict(sorted(detected.items())),
+    }
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            report["change_percent"] = compare(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'threat_detector'))
+
+from threat_detector import ThreatDetector
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'threat_detector', 'config.yaml')
+
+NORMAL_LOG = {
+    "@timestamp": "2024-10-01T12:00:00.000Z",
+    "log_id": "0b7f4f5e-3c1a-4a53-9d0b-6d1f0f3b3a11",
+    "client_ip": "84.21.7.190",
+    "method": "GET",
+    "url": "http://web:5000/products/3",
+    "status_code": 200,
+    "response_time_ms": 12,
+    "bytes_sent": 0,
+    "bytes_received": 512,
+    "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+    "referer": None,
+    "request_headers": {"Host": "web:5000", "Accept": "*/*"},
+    "response_headers": {"Content-Type": "application/json"},
+    "geo": {"country": "Japan", "city": "Tokyo", "timezone": "Asia/Tokyo"},
+    "request_body": None,
+    "type": "normal",
+    "@version": "1",
+    "path": "/mnt/logs/locust_json.log",
+}
+THREAT_LOG = dict(NORMAL_LOG, threat_type="sql_injection", type="threat",
+                  url="http://web:5000/products?id=' OR 1=1--")
+NO_ID_LOG = {key: value for key, value in NORMAL_LOG.items() if key != "log_id"}
+
+
+def legacy_reorder(config, log_entry):
+    ordered_log = {}
+    for field in config['field_order']:
+        if field in log_entry:
+            ordered_log[field] = log_entry[field]
+        elif field == "log_id":
+            ordered_log[field] = str(uuid.uuid4())
+        elif field == "threat_type":
+            ordered_log[field] = log_entry.get("type", "unknown")
+
+    for key, value in log_entry.items():
+        if key not in ordered_log:
+            ordered_log[key] = value
+
+    return ordered_log
+
+
+def time_per_log(func, log_entry, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(log_entry)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the per-log cost of reorder_log_fields")
+    parser.add_argument('--iterations', type=int, default=100000)
+    args = parser.parse_args()
+
+    with open(CONFIG_PATH, 'r') as f:
+        config = yaml.safe_load(f)
+    detector = ThreatDetector.for_detection(config)
+    detector.compile_field_layout()
+    skipping = ThreatDetector.for_detection(dict(config, processing=dict(config['processing'], reorder_fields=False)))
+    skipping.compile_field_layout()
+
+    for name, log_entry in (("normal", NORMAL_LOG), ("threat", THREAT_LOG), ("without_log_id", NO_ID_LOG)):
+        legacy = legacy_reorder(config, log_entry)
+        reordered = detector.reorder_log_fields(log_entry)
+        assert list(reordered) == list(legacy)
+        assert {k: v for k, v in reordered.items() if k != "log_id"} == {k: v for k, v in legacy.items() if k != "log_id"}
+
+        print(json.dumps({
+            "log": name,
+            "legacy_us_per_log": round(time_per_log(lambda entry: legacy_reorder(config, entry), log_entry,
+                                                    args.iterations), 3),
+            "layout_us_per_log": round(time_per_log(detector.reorder_log_fields, log_entry, args.iterations), 3),
+            "skip_us_per_log": round(time_per_log(skipping.reorder_log_fields, log_entry, args.iterations), 3),
+        }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import random
+import re
+import string
+import sys
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'threat_detector'))
+
+from threat_detector import RuleMatcher
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'threat_detector', 'config.yaml')
+
+SAMPLE_LOGS = [
+    "http://web:5000/ null {\"Host\": \"web:5000\", \"User-Agent\": \"Mozilla/5.0 (Windows NT 10.0; Win64; x64)\"}",
+    "http://web:5000/products/3 null {\"Host\": \"web:5000\", \"Accept\": \"*/*\"}",
+    "http://web:5000/cart {\"product_id\": 7, \"quantity\": 1} {\"Content-Type\": \"application/json\"}",
+    "http://web:5000/search?q=headphones null {\"Host\": \"web:5000\"}",
+    "http://web:5000/products?id=' UNION SELECT username, password FROM users-- null {\"User-Agent\": \"sqlmap/1.4.7#stable\"}",
+    "http://web:5000/search {\"q\": \"<img src=x onerror=alert('XSS')>\"} {\"User-Agent\": \"Nikto/2.1.6\"}",
+    "http://web:5000/static/..%252f..%252f..%252fetc%252fpasswd null {\"User-Agent\": \"Nikto/2.1.6\"}",
+    "http://web:5000/exec?cmd=date; cat /etc/passwd null {\"X-Forwarded-For\": \"10.0.0.1\"}",
+]
+
+
+def load_rules():
+    with open(CONFIG_PATH, 'r') as f:
+        config = yaml.safe_load(f)
+    return {threat_type: [rule['pattern'] if isinstance(rule, dict) else rule for rule in rules]
+            for threat_type, rules in config['detection_rules'].items() if threat_type != "ddos"}
+
+
+def synthetic_rules(rules, total, seed):
+    rng = random.Random(seed)
+    rules = {threat_type: list(patterns) for threat_type, patterns in rules.items()}
+    threat_types = list(rules)
+    count = sum(len(patterns) for patterns in rules.values())
+    while count < total:
+        keyword = ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(5, 8)))
+        suffix = ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 6)))
+        pattern = rng.choice([
+            f"{keyword}\\s*\\(",
+            f"{keyword}\\s+{suffix}",
+            f"<{keyword}[^>]*>",
+            f"{keyword}=\\s*['\"]",
+        ])
+        rules[rng.choice(threat_types)].append(pattern)
+        count += 1
+    return rules
+
+
+def legacy_match(compiled, content):
+    return {threat_type for threat_type, patterns in compiled.items()
+            if any(pattern.search(content) for pattern in patterns)}
+
+
+def time_per_log(func, logs, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for content in logs:
+            func(content)
+    return (time.perf_counter() - start) / (iterations * len(logs)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-log rule matching cost as the rule set grows")
+    parser.add_argument('--sizes', default='26,100,250,500,1000')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    base_rules = load_rules()
+    results = []
+    for size in (int(value) for value in args.sizes.split(',')):
+        rules = synthetic_rules(base_rules, size, args.seed)
+        compiled = {threat_type: [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+                    for threat_type, patterns in rules.items()}
+        matcher = RuleMatcher(rules)
+
+        for content in SAMPLE_LOGS:
+            assert matcher.match(content) == legacy_match(compiled, content), content
+
+        results.append({
+            "rules": len(matcher),
+            "legacy_us_per_log": round(time_per_log(lambda c: legacy_match(compiled, c), SAMPLE_LOGS, args.iterations), 2),
+            "matcher_us_per_log": round(time_per_log(matcher.match, SAMPLE_LOGS, args.iterations), 2),
+        })
+        print(json.dumps(results[-1]))
+
+
+if __name__ == "__main__":
+    main()
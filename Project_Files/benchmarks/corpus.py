@@ -0,0 +1,238 @@
+import argparse
+import json
+import random
+import uuid
+from datetime import datetime, timedelta
+
+HOST = "http://web:5000"
+START_TIME = datetime(2024, 10, 1, 12, 0, 0)
+
+NORMAL_USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 14_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (iPad; CPU OS 14_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 11; SM-G991B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.120 Mobile Safari/537.36',
+]
+THREAT_USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'Mozilla/5.0 (compatible; Baiduspider/2.0; +http://www.baidu.com/search/spider.html)',
+    'sqlmap/1.4.7#stable (http://sqlmap.org)',
+    'Nikto/2.1.6',
+    'Acunetix-WebVulnerability-Scanner/1.0',
+]
+NORMAL_GEO = [
+    {"country": "United States", "city": "New York", "timezone": "America/New_York"},
+    {"country": "United Kingdom", "city": "London", "timezone": "Europe/London"},
+    {"country": "Japan", "city": "Tokyo", "timezone": "Asia/Tokyo"},
+    {"country": "Australia", "city": "Sydney", "timezone": "Australia/Sydney"},
+    {"country": "Germany", "city": "Berlin", "timezone": "Europe/Berlin"},
+]
+THREAT_GEO = [
+    {"country": "Russia", "city": "Moscow", "timezone": "Europe/Moscow"},
+    {"country": "China", "city": "Beijing", "timezone": "Asia/Shanghai"},
+    {"country": "United States", "city": "Ashburn", "timezone": "America/New_York"},
+    {"country": "Netherlands", "city": "Amsterdam", "timezone": "Europe/Amsterdam"},
+]
+USERNAMES = ['applebee', 'ofgirl', 'bigbuffmen', 'alphagamer101', 'donaldtrump']
+PASSWORDS = ['password', '123456', 'admin', 'qwerty', 'letmein']
+SEARCH_TERMS = ["laptop", "phone", "book", "shirt", "headphones"]
+
+SQL_INJECTION_PAYLOADS = [
+    "' OR '1'='1",
+    "' UNION SELECT username, password FROM users--",
+    "admin'--",
+    "1; DROP TABLE users--",
+    "' OR 1=1--",
+    "' UNION SELECT null, version()--",
+    "' AND 1=2 UNION SELECT null, null--",
+    "' OR 'x'='x'--",
+    "1; EXEC xp_cmdshell('ping 127.0.0.1')--",
+    "<script>alert('XSS')</script>",
+    "<img src=x onerror=alert('XSS')>",
+    "../../../../etc/passwd",
+    "../../../../etc/passwd%00",
+    "php://filter/convert.base64-encode/resource=index.php",
+    "http://malicious-website.com/malicious-script.php",
+    "1; ls -la",
+    "1 && whoami",
+]
+XSS_PAYLOADS = [
+    "<script>alert('XSS')</script>",
+    "<img src=x onerror=alert('XSS')>",
+    "javascript:alert('XSS')",
+    "<svg onload=alert('XSS')>",
+    "'\"><script>alert('XSS')</script>",
+]
+PATH_TRAVERSAL_PAYLOADS = [
+    "../../../etc/passwd",
+    "..\\..\\..\\windows\\win.ini",
+    "....//....//....//etc/hosts",
+    "../../../var/log/auth.log",
+    "../../../var/www/html/config.php",
+    "../../../etc/shadow",
+    "%2e%2e%2f%2e%2e%2f%2e%2e%2fetc%2fpasswd",
+    "..%252f..%252f..%252fetc%252fpasswd",
+    "%252e%252e%252f%252e%252e%252f%252e%252e%252fetc%252fshadow",
+]
+COMMAND_INJECTION_PAYLOADS = ["; cat /etc/passwd", "& ipconfig", "| ls -la", "`whoami`", "$(echo 'vulnerable')"]
+SCRAPED_PAGES = ["/products", "/categories", "/reviews", "/comments", "/carts", "/information", "/aboutus"]
+
+
+class CorpusGenerator:
+    # Produces Elasticsearch hits shaped like the documents logstash indexes from the locust users.
+    # Task weights and payloads follow locustfile.py and threat_locustfile.py; everything random,
+    # including log ids and timestamps, comes from one seeded generator.
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.timestamp = START_TIME
+        self.count = 0
+
+    def client(self, threat):
+        rng = self.rng
+        return {
+            "client_ip": f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+            "user_agent": rng.choice(THREAT_USER_AGENTS if threat else NORMAL_USER_AGENTS),
+            "geo": rng.choice(THREAT_GEO if threat else NORMAL_GEO),
+        }
+
+    def log(self, client, method, path, data, threat_type=None):
+        rng = self.rng
+        self.timestamp += timedelta(milliseconds=rng.randint(1, 50))
+        if threat_type is None:
+            request_headers = {"Host": "web:5000", "User-Agent": client['user_agent'],
+                               "Accept-Encoding": "gzip, deflate", "Accept": "*/*"}
+            if method == "POST":
+                request_headers["Content-Type"] = "application/json"
+        else:
+            request_headers = {"X-Forwarded-For": client['client_ip'], "User-Agent": client['user_agent']}
+        body = json.dumps(data) if data else None
+        source = {
+            "log_id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "@timestamp": self.timestamp.isoformat(timespec='milliseconds') + "Z",
+            "client_ip": client['client_ip'],
+            "method": method,
+            "url": f"{HOST}{path}",
+            "status_code": 200,
+            "response_time_ms": rng.randint(2, 120),
+            "bytes_sent": len(body) if body else 0,
+            "bytes_received": rng.randint(200, 4000),
+            "user_agent": client['user_agent'],
+            "referer": rng.choice([None, "https://www.google.com", "https://www.bing.com"]),
+            "request_headers": request_headers,
+            "response_headers": {"Content-Type": "application/json", "Server": "Werkzeug/3.0.1 Python/3.9.20"},
+            "geo": client['geo'],
+            "request_body": data if data else None,
+            "@version": "1",
+            "type": "normal" if threat_type is None else "threat",
+            "path": "/mnt/logs/locust_json.log" if threat_type is None else "/mnt/logs/threat_locust_json.log",
+        }
+        if threat_type is not None:
+            source["threat_type"] = threat_type
+        self.count += 1
+        return {
+            "_index": f"locust-logs-{self.timestamp:%Y.%m.%d}",
+            "_id": f"{self.count:08d}",
+            "_source": source,
+            "sort": [int((self.timestamp - datetime(1970, 1, 1)).total_seconds() * 1000), self.count],
+        }
+
+    def normal_session(self):
+        rng = self.rng
+        client = self.client(False)
+        requests = []
+        for _ in range(rng.randint(1, 8)):
+            task = rng.choices(['index', 'product', 'add_to_cart', 'cart', 'checkout', 'login', 'search'],
+                               weights=[10, 5, 2, 2, 1, 1, 2])[0]
+            if task == 'index':
+                requests.append(("GET", "/", None))
+            elif task == 'product':
+                requests.append(("GET", f"/products/{rng.randint(1, 10)}", None))
+            elif task == 'add_to_cart':
+                requests.append(("POST", "/cart", {"product_id": rng.randint(1, 10), "quantity": 1}))
+            elif task == 'cart':
+                requests.append(("GET", "/cart", None))
+            elif task == 'checkout':
+                requests.append(("POST", "/checkout", {"payment_method": "credit_card"}))
+            elif task == 'login':
+                requests.append(("POST", "/login", {"username": rng.choice(USERNAMES), "password": rng.choice(PASSWORDS)}))
+            else:
+                requests.append(("GET", f"/search?q={rng.choice(SEARCH_TERMS)}", None))
+        return [self.log(client, method, path, data) for method, path, data in requests]
+
+    def threat_session(self):
+        rng = self.rng
+        task = rng.choices(['sql_injection', 'xss', 'path_traversal', 'command_injection', 'brute_force',
+                            'web_scraping', 'ddos'], weights=[3, 3, 2, 2, 2, 2, 2])[0]
+        client = self.client(True)
+        if task == 'sql_injection':
+            return [self.log(client, "GET", f"/products?id={rng.choice(SQL_INJECTION_PAYLOADS)}", None, task)]
+        if task == 'xss':
+            return [self.log(client, "POST", "/search", {"q": rng.choice(XSS_PAYLOADS)}, task)]
+        if task == 'path_traversal':
+            logs = []
+            for _ in range(rng.randint(1, 5)):
+                if rng.random() < 0.5:
+                    payload = rng.choice(PATH_TRAVERSAL_PAYLOADS)
+                else:
+                    payload = "../" * rng.randint(1, 6) + rng.choice(["etc/passwd", "etc/hosts", "windows/win.ini"])
+                logs.append(self.log(self.client(True), "GET", f"/static/{payload}", None, task))
+            return logs
+        if task == 'command_injection':
+            return [self.log(client, "GET", f"/exec?cmd=date{rng.choice(COMMAND_INJECTION_PAYLOADS)}", None, task)]
+        if task == 'brute_force':
+            return [self.log(self.client(True), "POST", "/login", {"username": username, "password": password}, task)
+                    for username in ['admin', 'root', 'user', 'test', 'guest'] for password in PASSWORDS]
+        if task == 'web_scraping':
+            return [self.log(client, "GET", page, None, task) for page in SCRAPED_PAGES]
+
+        # A DDoS burst keeps one client for all of its requests half of the time, like the locust user
+        logs = []
+        rotate = rng.random() < 0.5
+        for _ in range(rng.randint(5, 15)):
+            if rotate:
+                client = self.client(True)
+            for _ in range(rng.randint(1, 20)):
+                method, path, data = rng.choice([
+                    ("GET", "/", None),
+                    ("GET", f"/products/{rng.randint(1, 10)}", None),
+                    ("POST", "/cart", {"product_id": rng.randint(1, 10), "quantity": 1}),
+                    ("GET", "/cart", None),
+                    ("POST", "/checkout", {"payment_method": "credit_card"}),
+                ])
+                logs.append(self.log(client, method, path, data, task))
+        return logs
+
+
+def generate_corpus(size, attack_ratio=0.2, seed=42):
+    # Sessions are drawn until the corpus is full, picking an attack session whenever attack logs
+    # are below attack_ratio of the logs so far
+    generator = CorpusGenerator(seed)
+    hits = []
+    attacks = 0
+    while len(hits) < size:
+        if attacks < attack_ratio * (len(hits) + 1):
+            session = generator.threat_session()
+            attacks += len(session)
+        else:
+            session = generator.normal_session()
+        hits.extend(session)
+    return hits[:size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic corpus of locust-shaped logs as JSON lines")
+    parser.add_argument('--logs', type=int, default=10000)
+    parser.add_argument('--attack-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='corpus.jsonl')
+    args = parser.parse_args()
+
+    with open(args.output, 'w') as f:
+        for hit in generate_corpus(args.logs, args.attack_ratio, args.seed):
+            f.write(json.dumps(hit) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,1178 @@
+import argparse
+import atexit
+import bisect
+import functools
+import hashlib
+import itertools
 import json
+import random
 import re
-from collections import defaultdict, deque
+import signal
+import sys
+import unicodedata
+from collections import defaultdict, deque, Counter, OrderedDict
 from datetime import datetime, timezone, timedelta
+from urllib.parse import unquote
 import os
 import logging
+import logging.handlers
+import multiprocessing
+import queue
+import socket
+import threading
 import yaml
 import time
 import uuid
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+import zlib
+import prometheus_client
+import redis
+from elasticsearch import Elasticsearch, ApiError, TransportError
+from elasticsearch.helpers import streaming_bulk
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
 
-log_dir = '/mnt/logs'
-os.makedirs(log_dir, exist_ok=True)
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 
+logger = logging.getLogger(__name__)
 threat_logger = logging.getLogger('threat_logger')
-threat_logger.setLevel(logging.WARNING)
-file_handler = logging.FileHandler(os.path.join(log_dir, 'detected_threats.log'))
-file_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
-threat_logger.addHandler(file_handler)
 
-threat_logger.propagate = False
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    # The queue never leaves the process, so records are passed on as they are and formatted
+    # on the listener thread instead of the thread that logged them
+    def prepare(self, record):
+        return record
+
+
+class BatchedFileHandler(logging.FileHandler):
+    # Records go to the file object's buffer only; the listener flushes once its queue drains
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    def __init__(self, record_queue, *handlers, flush_interval=1.0):
+        super().__init__(record_queue, *handlers, respect_handler_level=True)
+        self.flush_interval = flush_interval
+        self.next_flush = time.monotonic() + flush_interval
+
+    def dequeue(self, block):
+        # Flushes whenever the queue runs dry, and at least every flush_interval under steady load
+        try:
+            record = self.queue.get_nowait()
+        except queue.Empty:
+            self.flush()
+            record = self.queue.get()
+        if time.monotonic() >= self.next_flush:
+            self.flush()
+        return record
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+        self.next_flush = time.monotonic() + self.flush_interval
+
+    def stop(self):
+        super().stop()
+        self.flush()
+
+
+class ThreatRecordFormatter(logging.Formatter):
+    # Threat documents are logged as dicts and only serialised here, on the listener thread
+    def format(self, record):
+        if isinstance(record.msg, dict):
+            record.msg = json.dumps(record.msg)
+        return super().format(record)
+
+
+def setup_logging(config):
+    # Detection threads only put records on in-memory queues; console output and the threat log
+    # are written by listener threads, the threat log in batches
+    settings = config.get('logging', {})
+    threat_log = settings.get('threat_log', '/mnt/logs/detected_threats.log')
+    os.makedirs(os.path.dirname(threat_log), exist_ok=True)
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(LOG_FORMAT))
+    console_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [LocalQueueHandler(console_queue)]
+    root.setLevel(settings.get('level', 'INFO'))
+
+    threat_file = BatchedFileHandler(threat_log)
+    threat_file.setFormatter(ThreatRecordFormatter('%(asctime)s - %(message)s'))
+    threat_queue = queue.SimpleQueue()
+    threat_logger.handlers = [LocalQueueHandler(threat_queue)]
+    threat_logger.setLevel(logging.WARNING)
+    threat_logger.propagate = False
+
+    listeners = [logging.handlers.QueueListener(console_queue, console),
+                 BatchingQueueListener(threat_queue, threat_file, flush_interval=settings.get('flush_interval', 1.0))]
+    for listener in listeners:
+        listener.start()
+        atexit.register(listener.stop)
+    return listeners
+
+
+DOCS_FETCHED = prometheus_client.Counter('threat_detector_docs_fetched_total', 'Logs fetched from the source index')
+DOCS_PROCESSED = prometheus_client.Counter('threat_detector_docs_processed_total', 'Logs run through detection')
+DOCS_INDEXED = prometheus_client.Counter('threat_detector_docs_indexed_total', 'Documents confirmed by bulk indexing')
+STAGE_SECONDS = prometheus_client.Histogram('threat_detector_stage_seconds', 'Time spent per batch in each stage',
+                                            ['stage'])
+RULE_MATCHES = prometheus_client.Counter('threat_detector_rule_matches_total', 'Logs flagged per threat type',
+                                         ['threat_type'])
+BULK_FAILURES = prometheus_client.Counter('threat_detector_bulk_failures_total',
+                                          'Bulk actions spilled to the retry queue or dead-lettered', ['outcome'])
+CHECKPOINT_LAG = prometheus_client.Gauge('threat_detector_checkpoint_lag_seconds',
+                                         'Seconds between now and the last processed timestamp')
+DDOS_TRACKED_IPS = prometheus_client.Gauge('threat_detector_ddos_tracked_ips', 'Client IPs with a DDoS window')
+
+
+REGEX_METACHARACTERS = set('.^$*+?{}[]()|\\')
+REGEX_QUANTIFIERS = set('*+?{')
+REGEX_CLASS_ESCAPES = set('dDsSwWbBAZ0123456789')
+
+
+def split_alternatives(pattern):
+    # Split a pattern on its top-level "|" so every branch can be indexed on its own prefix
+    branches, depth, in_class, escaped, start = [], 0, False, False, 0
+    for index, char in enumerate(pattern):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            branches.append(pattern[start:index])
+            start = index + 1
+    branches.append(pattern[start:])
+    return branches
+
+
+def literal_prefix(pattern):
+    # Returns (literal, remainder) where literal is the run of plain characters every match of
+    # the pattern has to start with, and remainder is the regex that has to follow it.
+    literal, index = [], 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '\\' and index + 1 < len(pattern) and pattern[index + 1] not in REGEX_CLASS_ESCAPES \
+                and not pattern[index + 1].isalpha():
+            atom, size = pattern[index + 1], 2
+        elif char not in REGEX_METACHARACTERS and not char.isspace():
+            atom, size = char, 1
+        else:
+            break
+        if index + size < len(pattern) and pattern[index + size] in REGEX_QUANTIFIERS:
+            break
+        literal.append(atom)
+        index += size
+    return ''.join(literal).casefold(), pattern[index:]
+
+
+def required_literals(pattern):
+    # Collect the literal runs that every match of the pattern has to contain. Anything
+    # optional, alternated or inside an assertion is skipped, so the result may be empty.
+    literals = set()
+
+    def walk(items):
+        run = []
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                run.append(chr(av))
+                continue
+            if run:
+                literals.add(''.join(run).casefold())
+                run = []
+            if op is sre_parse.SUBPATTERN:
+                walk(av[-1])
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+                walk(av[2])
+        if run:
+            literals.add(''.join(run).casefold())
+
+    walk(sre_parse.parse(pattern, re.IGNORECASE))
+    return literals
+
+
+def trie_regex(entries):
+    # entries are (literal, regex) pairs; the literals are folded into a trie so the regex
+    # engine only follows prefixes that can still match, and the regex runs after its literal
+    trie = {}
+    for literal, regex in entries:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(regex)
+
+    def emit(node):
+        alternatives = [re.escape(char) + emit(child) for char, child in node.items() if char is not None]
+        alternatives.extend(node.get(None, []))
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return "(?:" + "|".join(alternatives) + ")"
+
+    return "|".join(re.escape(char) + emit(child) for char, child in trie.items())
+
+
+SCAN_FIELDS = ('url', 'request_body', 'request_headers')
+RELOADABLE_SECTIONS = ('detection_rules', 'detection_fields', 'normalization', 'verdict_cache', 'profiling',
+                       'evaluation')
+URL_FIELDS = ('url', 'path', 'query')
+HEADER_FIELD_PREFIX = 'request_headers.'
+LINE_BREAKS = str.maketrans('\r\n', '  ')
+
+
+def flatten_values(value, parts):
+    # Collects the keys and scalar values of a nested body or header structure as raw strings,
+    # so rules see exactly what was sent rather than its JSON-escaped form. Line breaks inside a
+    # value become spaces, since the newlines joining the parts are the only boundaries rules stop at
+    if type(value) is str:
+        parts.append(value.translate(LINE_BREAKS))
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            parts.append(key.translate(LINE_BREAKS) if type(key) is str else str(key))
+            if type(item) is str:
+                parts.append(item.translate(LINE_BREAKS))
+            elif item is not None:
+                flatten_values(item, parts)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            flatten_values(item, parts)
+    elif value is not None:
+        parts.append(str(value))
+    return parts
+
+
+def canonical_form(text, max_rounds=3):
+    # Percent-decodes until the text stops changing (double-encoded payloads take two rounds) and
+    # applies NFKC so full-width and compatibility characters fold to their ASCII equivalents.
+    # Newlines separate the values of a segment, so each value is decoded on its own and a decoded
+    # %0a or %0d becomes a space instead of a boundary a payload could be split across
+    if '\n' in text:
+        return "\n".join(canonical_form(part, max_rounds) for part in text.split("\n"))
+    for _ in range(max_rounds):
+        decoded = unquote(text) if '%' in text else text
+        if not decoded.isascii():
+            decoded = unicodedata.normalize('NFKC', decoded)
+        if decoded == text:
+            break
+        text = decoded
+    return text.translate(LINE_BREAKS).casefold()
+
+
+def detection_field(field):
+    # Header names are matched case-insensitively, so they are normalised once at compile time
+    if field in SCAN_FIELDS or field in URL_FIELDS:
+        return field
+    if field.startswith(HEADER_FIELD_PREFIX) and len(field) > len(HEADER_FIELD_PREFIX):
+        return HEADER_FIELD_PREFIX + field[len(HEADER_FIELD_PREFIX):].lower()
+    raise ValueError(f"Unknown detection field: {field}")
+
+
+def field_segment(log_entry, field):
+    if field in URL_FIELDS:
+        url = log_entry.get('url') or ''
+        if type(url) is not str:
+            url = str(url)
+        if field == 'url':
+            return url
+        path, _, query = url.partition('?')
+        if field == 'query':
+            return query
+        scheme_end = path.find('://')
+        if scheme_end != -1:
+            slash = path.find('/', scheme_end + 3)
+            path = path[slash:] if slash != -1 else ''
+        return path
+
+    if field.startswith(HEADER_FIELD_PREFIX):
+        headers = log_entry.get('request_headers')
+        if not isinstance(headers, dict):
+            return ''
+        name = field[len(HEADER_FIELD_PREFIX):]
+        for key, value in headers.items():
+            if str(key).lower() == name:
+                return "\n".join(flatten_values(value, []))
+        return ''
+
+    return "\n".join(flatten_values(log_entry.get(field), []))
+
+
+class EvaluationTimeout(Exception):
+    def __init__(self, threats):
+        super().__init__("rule evaluation exceeded its time budget")
+        self.threats = threats
+
+
+class RuleMatcher:
+    def __init__(self, rules, cache_size=256):
+        self.rules = [
+            (threat_type, pattern)
+            for threat_type, patterns in rules.items()
+            for pattern in patterns
+        ]
+        self.type_patterns = {
+            threat_type: re.compile("|".join(f"(?:{pattern})" for pattern in patterns), re.IGNORECASE)
+            for threat_type, patterns in rules.items() if patterns
+        }
+        self.branches = [branch for _, pattern in self.rules for branch in split_alternatives(pattern)]
+
+        # Literal prefilter: every branch is indexed under the longest literal it requires and
+        # only branches whose literals all appear in the content are handed to the automaton.
+        self.anchor_branches = defaultdict(list)
+        self.extra_literals = []
+        self.unfiltered = set()
+        for index, branch in enumerate(self.branches):
+            literals = sorted(required_literals(branch), key=len, reverse=True)
+            self.extra_literals.append(literals[1:])
+            if literals:
+                self.anchor_branches[literals[0]].append(index)
+            else:
+                self.unfiltered.add(index)
+        self.implied_anchors = {
+            anchor: [other for other in self.anchor_branches if other in anchor]
+            for anchor in self.anchor_branches
+        }
+        self.literal_scanner = re.compile(
+            trie_regex((anchor, "") for anchor in self.anchor_branches)
+        ) if self.anchor_branches else None
+
+        self.cache_size = cache_size
+        self.automata = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def build_automaton(self, indexes):
+        # Fold the candidate branches into one regex factored on their literal prefixes. The
+        # trie is matched against casefolded content and the rest of each branch keeps its
+        # case-insensitive semantics.
+        anchored, unanchored = [], []
+        for index in sorted(indexes):
+            prefix, remainder = literal_prefix(self.branches[index])
+            if prefix:
+                anchored.append((prefix, f"(?i:{remainder})" if remainder else ""))
+            else:
+                unanchored.append(f"(?i:{self.branches[index]})")
+        return re.compile("|".join(filter(None, [trie_regex(anchored)] + unanchored)))
+
+    def automaton_for(self, indexes):
+        with self.lock:
+            automaton = self.automata.get(indexes)
+            if automaton is not None:
+                self.automata.move_to_end(indexes)
+                return automaton
+        automaton = self.build_automaton(indexes)
+        with self.lock:
+            self.automata[indexes] = automaton
+            if len(self.automata) > self.cache_size:
+                self.automata.popitem(last=False)
+        return automaton
+
+    def candidates(self, content, deadline=None):
+        candidates = set(self.unfiltered)
+        if self.literal_scanner is None:
+            return candidates
+
+        # The scanner reports the longest anchor starting at each hit; shorter anchors
+        # contained in it are implied, and restarting one character later finds overlaps.
+        anchors = set()
+        position = 0
+        while len(anchors) < len(self.anchor_branches):
+            match = self.literal_scanner.search(content, position)
+            if deadline is not None and time.thread_time() > deadline:
+                raise EvaluationTimeout(set())
+            if match is None:
+                break
+            anchors.update(self.implied_anchors[match.group()])
+            position = match.start() + 1
+        for anchor in anchors:
+            for index in self.anchor_branches[anchor]:
+                if all(literal in content for literal in self.extra_literals[index]):
+                    candidates.add(index)
+        return candidates
+
+    def match(self, content, deadline=None):
+        threats = set()
+        content = content.casefold()
+        candidates = self.candidates(content, deadline)
+        if not candidates:
+            return threats
+
+        automaton = self.automaton_for(frozenset(candidates))
+        position = 0
+        while len(threats) < len(self.type_patterns):
+            # A single search cannot be interrupted, so the deadline is checked after each one
+            match = automaton.search(content, position)
+            if deadline is not None and time.thread_time() > deadline:
+                raise EvaluationTimeout(threats)
+            if match is None:
+                break
+            # The automaton only tells us that some rule matches here, so attribute the
+            # position to every threat type that has a rule matching at it.
+            start = match.start()
+            for threat_type, pattern in self.type_patterns.items():
+                if threat_type not in threats and pattern.match(content, start):
+                    threats.add(threat_type)
+                if deadline is not None and time.thread_time() > deadline:
+                    raise EvaluationTimeout(threats)
+            position = start + 1
+
+        return threats
+
+
+class SlidingWindowCounter:
+    __slots__ = ('window', 'lateness', 'events')
+
+    def __init__(self, window, max_events, lateness=0):
+        self.window = window
+        self.lateness = lateness
+        self.events = deque(maxlen=max_events)
+
+    def add(self, timestamp):
+        # Timestamps are kept sorted, so expired ones are always at the left end and each one
+        # is popped exactly once: constant amortized work per request. Out-of-order events
+        # are inserted from the right, which is cheap because lateness is bounded; events
+        # later than that are not counted and None is returned.
+        events = self.events
+        if events and timestamp < events[-1]:
+            if timestamp < events[-1] - self.lateness:
+                return None
+            index = len(events)
+            while index and events[index - 1] > timestamp:
+                index -= 1
+            if len(events) == events.maxlen:
+                events.popleft()
+                index -= 1
+            if index >= 0:
+                events.insert(index, timestamp)
+        else:
+            events.append(timestamp)
+
+        horizon = events[-1] - self.window
+        while events[0] < horizon:
+            events.popleft()
+        return len(events)
+
+    def count_at(self, timestamp):
+        # The count add() would have returned for an event already in the window
+        events = self.events
+        return bisect.bisect_right(events, timestamp) - bisect.bisect_left(events, timestamp - self.window)
+
+    def __len__(self):
+        return len(self.events)
+
+
+class IPStateTable:
+    def __init__(self, factory, ttl, max_entries):
+        self.factory = factory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Ordered from least to most recently seen, so both idle and LRU victims are at the front
+        self.entries = OrderedDict()
+        self.ttl_evictions = 0
+        self.lru_evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, ip, now):
+        entry = self.entries.get(ip)
+        if entry is None:
+            entry = self.entries[ip] = [now, self.factory()]
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.lru_evictions += 1
+        else:
+            entry[0] = max(entry[0], now)
+            self.entries.move_to_end(ip)
+        self.expire(now)
+        return entry[1]
+
+    def expire(self, now):
+        horizon = now - self.ttl
+        entries = self.entries
+        while entries:
+            oldest = next(iter(entries))
+            if entries[oldest][0] >= horizon:
+                break
+            del entries[oldest]
+            self.ttl_evictions += 1
+
+    def stats(self, sample_size=100):
+        # Per-entry size is estimated from the most recently used entries to keep this cheap
+        sample = []
+        for ip in reversed(self.entries):
+            if len(sample) >= sample_size:
+                break
+            last_seen, state = self.entries[ip]
+            sample.append(sys.getsizeof(ip) + sys.getsizeof(self.entries[ip]) + sys.getsizeof(last_seen) +
+                          sys.getsizeof(state) + sum(sys.getsizeof(getattr(state, slot))
+                                                     for slot in getattr(state, '__slots__', ())))
+        entry_bytes = sum(sample) / len(sample) if sample else 0
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_evictions": self.ttl_evictions,
+            "lru_evictions": self.lru_evictions,
+            "estimated_bytes": int(sys.getsizeof(self.entries) + entry_bytes * len(self.entries)),
+        }
+
+
+class RuleProfiler:
+    # The matchers fuse all patterns into one automaton, so time cannot be attributed to a single
+    # pattern there. The profiler runs every pattern on its own over the same segments instead,
+    # which is why it is opt-in and only sees a sample of the logs.
+    def __init__(self, entries, sample_rate):
+        self.sample_rate = sample_rate
+        self.patterns = [(threat_type, pattern, fields, re.compile(pattern, re.IGNORECASE))
+                         for threat_type, pattern, fields in entries]
+        self.lock = threading.Lock()
+        self.stats = {(threat_type, pattern, fields): [0.0, 0, 0, 0.0]
+                      for threat_type, pattern, fields, _ in self.patterns}
+
+    def profile(self, segments):
+        contents = {}
+        timings = []
+        for threat_type, pattern, fields, compiled in self.patterns:
+            content = contents.get(fields)
+            if content is None:
+                content = contents[fields] = "\n".join(segments[field] for field in fields)
+            started = time.perf_counter()
+            matched = compiled.search(content) is not None
+            timings.append(((threat_type, pattern, fields), time.perf_counter() - started, matched))
+        with self.lock:
+            for key, elapsed, matched in timings:
+                stats = self.stats[key]
+                stats[0] += elapsed
+                stats[1] += 1
+                stats[2] += matched
+                stats[3] = max(stats[3], elapsed)
+
+    def snapshot(self):
+        with self.lock:
+            return {key: list(stats) for key, stats in self.stats.items()}
+
+
+def rank_rule_profile(snapshots, threshold):
+    # Merges profiler snapshots (one per detection process) into rows ranked by total time;
+    # rules whose slowest single evaluation exceeded threshold seconds are marked slow
+    merged = {}
+    for snapshot in snapshots:
+        for key, (total, evaluations, matches, worst) in snapshot.items():
+            stats = merged.setdefault(key, [0.0, 0, 0, 0.0])
+            stats[0] += total
+            stats[1] += evaluations
+            stats[2] += matches
+            stats[3] = max(stats[3], worst)
+    rows = [{
+        "threat_type": threat_type,
+        "pattern": pattern,
+        "fields": list(fields),
+        "total_ms": round(total * 1000, 3),
+        "evaluations": evaluations,
+        "matches": matches,
+        "mean_us": round(total / evaluations * 1e6, 2) if evaluations else 0.0,
+        "worst_ms": round(worst * 1000, 3),
+        "slow": worst > threshold,
+    } for (threat_type, pattern, fields), (total, evaluations, matches, worst) in merged.items()]
+    rows.sort(key=lambda row: row['total_ms'], reverse=True)
+    return rows
+
+
+class CompiledRules:
+    # Everything a detection pass needs from the rule configuration, swapped in as one object
+    def __init__(self, matchers, normalize_segment, verdict_cache, compile_seconds, profiler=None,
+                 max_field_length=None, time_budget=None):
+        self.matchers = matchers
+        self.fields = tuple(dict.fromkeys(field for fields, _ in matchers for field in fields))
+        self.normalize_segment = normalize_segment
+        self.verdict_cache = verdict_cache
+        self.compile_seconds = compile_seconds
+        self.profiler = profiler
+        self.time_budget = time_budget
+
+        # A single header is capped by its own entry, then by request_headers, then by default
+        max_field_length = max_field_length or {}
+        self.field_limits = {
+            field: max_field_length.get(field, max_field_length.get(field.partition('.')[0],
+                                                                    max_field_length.get('default')))
+            for field in self.fields
+        }
+
+    def size(self):
+        return {
+            "rules": sum(len(matcher) for _, matcher in self.matchers),
+            "matchers": len(self.matchers),
+            "literal_anchors": sum(len(matcher.anchor_branches) for _, matcher in self.matchers),
+            "fields": len(self.fields),
+        }
+
+
+class RuleReloader:
+    def __init__(self, config_path, interval, load):
+        self.config_path = config_path
+        self.interval = interval
+        self.load = load
+        self.lock = threading.Lock()
+        self.pending = None
+        self.signature = self.file_signature()
+        self.thread = threading.Thread(target=self.watch, name='rule-reloader', daemon=True)
+        self.thread.start()
+
+    def file_signature(self):
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def watch(self):
+        # Compiles changed rules on this thread, so detection only pays for the swap
+        while True:
+            time.sleep(self.interval)
+            signature = self.file_signature()
+            if signature is None or signature == self.signature:
+                continue
+            self.signature = signature
+            try:
+                loaded = self.load()
+            except Exception as e:
+                logger.error(f"Failed to reload detection rules from {self.config_path}, keeping the current rules: {str(e)}")
+                continue
+            with self.lock:
+                self.pending = loaded
+
+    def take(self):
+        with self.lock:
+            pending, self.pending = self.pending, None
+        return pending
+
+
+class VerdictCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, now):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] >= now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, verdict, now):
+        with self.lock:
+            self.entries[key] = (now + self.ttl, verdict)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def with_hit_rate(stats):
+    lookups = stats.get('hits', 0) + stats.get('misses', 0)
+    return dict(stats, hit_rate=round(stats['hits'] / lookups, 4) if lookups else 0.0)
+
+
+class AdaptiveScheduler:
+    def __init__(self, processing):
+        self.batch_size = processing['batch_size']
+        self.min_batch_size = processing.get('min_batch_size', self.batch_size)
+        self.max_batch_size = processing.get('max_batch_size', self.batch_size)
+        self.target_latency = processing.get('target_batch_latency', 1.0)
+        self.min_poll_interval = processing.get('min_poll_interval', processing['poll_interval'])
+        self.max_poll_interval = processing['poll_interval']
+        self.idle_delay = self.min_poll_interval
+
+    def record(self, count, full, latency):
+        # Returns how long to wait before the next fetch. Full batches mean a backlog is
+        # waiting, so fetch again straight away and size the next batch to the latency target;
+        # only an empty fetch backs off, doubling up to poll_interval.
+        if full:
+            if latency > self.target_latency:
+                self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            elif latency < self.target_latency / 2:
+                self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+            self.idle_delay = self.min_poll_interval
+            return 0
+        if count:
+            self.idle_delay = self.min_poll_interval
+            return self.min_poll_interval
+        delay = self.idle_delay
+        self.idle_delay = min(self.max_poll_interval, self.idle_delay * 2)
+        return delay
+
+
+def detection_worker(shard, config, inbox, outbox):
+    logging.basicConfig(level=config.get('logging', {}).get('level', 'INFO'), format=LOG_FORMAT)
+    detector = ThreatDetector.for_detection(config)
+    for sequence, entries in iter(inbox.get, None):
+        if sequence is None:
+            detector.apply_config(entries, detector.compile_detection(entries))
+            continue
+        results = [(index, detector.detect_threats(log_entry, replayed=replayed))
+                   for index, log_entry, replayed in entries]
+        outbox.put((sequence, shard, results, detector.detection_stats()))
+
+
+class DetectionProcessPool:
+    def __init__(self, config, processes):
+        self.config = config
+        self.processes = processes
+        self.context = multiprocessing.get_context('spawn')
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.workers = []
+        self.worker_stats = {}
+        self.start()
+
+    def start(self):
+        self.outbox = self.context.Queue()
+        self.inboxes = [self.context.Queue() for _ in range(self.processes)]
+        self.workers = [
+            self.context.Process(target=detection_worker, args=(shard, self.config, inbox, self.outbox),
+                                 name=f'detection-worker-{shard}', daemon=True)
+            for shard, inbox in enumerate(self.inboxes)
+        ]
+        for worker in self.workers:
+            worker.start()
+        logger.info(f"Started {self.processes} detection worker processes")
+
+    def reload(self, config):
+        # Workers recompile before their next batch; restarted workers start from the new config
+        with self.lock:
+            self.config = config
+            for inbox in self.inboxes:
+                inbox.put((None, config))
+
+    def restart(self):
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
+        self.worker_stats = {}
+        self.start()
+
+    def detect(self, log_entries, replayed):
+        # Logs are sharded on a stable hash of client_ip so each IP's DDoS window lives in
+        # exactly one worker and sees its requests in order; results are merged back by position.
+        shards = [[] for _ in self.inboxes]
+        for index, log_entry in enumerate(log_entries):
+            shard = zlib.crc32(str(log_entry.get('client_ip', '')).encode()) % self.processes
+            shards[shard].append((index, log_entry, replayed[index]))
+
+        results = [None] * len(log_entries)
+        with self.lock:
+            self.sequence += 1
+            pending = 0
+            for inbox, entries in zip(self.inboxes, shards):
+                if entries:
+                    inbox.put((self.sequence, entries))
+                    pending += 1
+            while pending:
+                try:
+                    sequence, shard, shard_results, stats = self.outbox.get(timeout=1)
+                except queue.Empty:
+                    if not all(worker.is_alive() for worker in self.workers):
+                        self.restart()
+                        raise RuntimeError("A detection worker process exited; workers were restarted")
+                    continue
+                if sequence != self.sequence:
+                    continue
+                for index, threats in shard_results:
+                    results[index] = threats
+                self.worker_stats[shard] = stats
+                pending -= 1
+        return results
+
+
+class BulkWriter:
+    def __init__(self, config):
+        self.config = config
+        self.retry_queue_path = config.get('retry_queue', '/mnt/logs/bulk_retry_queue.jsonl')
+        self.dead_letter_path = config.get('dead_letter_file', '/mnt/logs/bulk_dead_letter.jsonl')
+        self.next_drain = 0
+        self.drain_backoff = config.get('initial_backoff', 1)
+        self.indexed = 0
+        self.spilled = 0
+        self.dead_lettered = 0
+
+    @staticmethod
+    def retryable(status):
+        return not isinstance(status, int) or status == 429 or status >= 500
+
+    def append_lines(self, path, records):
+        count = 0
+        with open(path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        return count
+
+    def write(self, es, actions):
+        # Items rejected with 429 are retried with exponential backoff by streaming_bulk; anything
+        # still failing with a retryable status, or left unconfirmed when Elasticsearch becomes
+        # unreachable, is spilled to the on-disk retry queue. Other failures go to the dead letter
+        # file. Every action carries an _id (the source log's, when there is one) so a replayed
+        # action overwrites instead of duplicating.
+        pending = {}
+        for action in actions:
+            action.setdefault('_id', uuid.uuid4().hex)
+            pending[action['_id']] = action
+        if not pending:
+            return 0
+
+        indexed, retry, dead = 0, [], []
+        try:
+            for ok, item in streaming_bulk(es, list(pending.values()),
+                                           chunk_size=self.config.get('chunk_size', 500),
+                                           max_chunk_bytes=self.config.get('max_chunk_bytes', 10485760),
+                                           max_retries=self.config.get('max_retries', 5),
+                                           initial_backoff=self.config.get('initial_backoff', 1),
+                                           max_backoff=self.config.get('max_backoff', 60),
+                                           raise_on_error=False, raise_on_exception=False, yield_ok=True):
+                info = next(iter(item.values()))
+                action = pending.pop(info.get('_id'), None)
+                if ok:
+                    indexed += 1
+                elif action is not None and self.retryable(info.get('status')):
+                    retry.append(action)
+                elif action is not None:
+                    dead.append({"action": action, "status": info.get('status'), "error": str(info.get('error'))})
+        except (ApiError, TransportError) as e:
+            logger.error(f"Bulk indexing interrupted: {str(e)}")
+            retry.extend(pending.values())
+            pending = {}
+
+        DOCS_INDEXED.inc(indexed)
+        BULK_FAILURES.labels('retry').inc(len(retry))
+        BULK_FAILURES.labels('dead_letter').inc(len(dead))
+        if retry:
+            self.spilled += self.append_lines(self.retry_queue_path, retry)
+            logger.warning(f"Spilled {len(retry)} actions to the bulk retry queue")
+        if dead:
+            self.dead_lettered += self.append_lines(self.dead_letter_path, dead)
+            logger.error(f"Wrote {len(dead)} permanently rejected actions to {self.dead_letter_path}")
+        self.indexed += indexed
+        logger.info(f"Indexed {indexed} logs. Failed: {len(retry) + len(dead)}")
+        return indexed
+
+    @staticmethod
+    def queued_actions(lines, unreadable):
+        # A crash while spilling can leave a torn last line; such lines are collected for the
+        # dead letter file instead of stopping the drain
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                action = json.loads(line)
+            except json.JSONDecodeError as e:
+                unreadable.append({"line": line.rstrip("\n"), "error": str(e)})
+                continue
+            if not isinstance(action, dict):
+                unreadable.append({"line": line.rstrip("\n"), "error": "not a bulk action"})
+                continue
+            yield action
+
+    def drain(self, es):
+        # Replays the retry queue in bounded slices. The queue is moved aside first, so actions
+        # that fail again are appended to a fresh queue, and a crash mid-drain leaves the moved
+        # file to be picked up next time.
+        draining_path = self.retry_queue_path + '.draining'
+        if time.monotonic() < self.next_drain:
+            return
+        if not os.path.exists(draining_path):
+            if not os.path.exists(self.retry_queue_path):
+                return
+            os.replace(self.retry_queue_path, draining_path)
+
+        spilled_before = self.spilled
+        unreadable = []
+        with open(draining_path, 'r') as f:
+            actions = self.queued_actions(f, unreadable)
+            while True:
+                chunk = list(itertools.islice(actions, self.config.get('drain_size', 5000)))
+                if not chunk:
+                    break
+                logger.info(f"Replaying {len(chunk)} actions from the bulk retry queue")
+                self.write(es, chunk)
+        if unreadable:
+            BULK_FAILURES.labels('dead_letter').inc(len(unreadable))
+            self.dead_lettered += self.append_lines(self.dead_letter_path, unreadable)
+            logger.error(f"Moved {len(unreadable)} unreadable lines from the bulk retry queue to {self.dead_letter_path}")
+        os.remove(draining_path)
+
+        if self.spilled > spilled_before:
+            self.next_drain = time.monotonic() + self.drain_backoff
+            self.drain_backoff = min(self.drain_backoff * 2, self.config.get('max_backoff', 60))
+        else:
+            self.drain_backoff = self.config.get('initial_backoff', 1)
+
+
+class Checkpoint:
+    # The cursor is stored as JSON: the millisecond it points at and the ids already processed at
+    # that millisecond. Writes go to a temporary file that is fsynced and renamed over the
+    # checkpoint, so a crash leaves either the old or the new cursor. Files holding a bare ISO
+    # timestamp from older versions are still read.
+    def __init__(self, path, flush_batches=1, flush_interval=0):
+        self.path = path
+        self.flush_batches = flush_batches
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = None
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                content = f.read().strip()
+        except FileNotFoundError:
+            return None
+        if content.startswith('{'):
+            state = json.loads(content)
+            return state['cursor_millis'], frozenset(state.get('boundary_ids', []))
+        return int(ThreatDetector.parse_timestamp(content).timestamp() * 1000), frozenset()
+
+    def save(self, cursor):
+        # Returns the cursor if it was written, or None if it is waiting for the next flush
+        with self.lock:
+            self.pending = cursor
+            self.unflushed += 1
+            if self.unflushed < self.flush_batches and time.monotonic() - self.last_flush < self.flush_interval:
+                return None
+            return self.write_pending()
+
+    def flush(self):
+        with self.lock:
+            return self.write_pending() if self.pending is not None else None
+
+    def write_pending(self):
+        millis, boundary_ids = self.pending
+        state = {
+            "timestamp": datetime.fromtimestamp(millis / 1000, timezone.utc).isoformat(),
+            "cursor_millis": millis,
+            "boundary_ids": sorted(boundary_ids),
+        }
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+        cursor, self.pending = self.pending, None
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+        return cursor
+
+
+PARTITION_SCRIPT = """
+if (doc[params.field].size() == 0) {
+    return params.index == 0;
+}
+return Math.floorMod(doc[params.field].value.hashCode(), params.count) == params.index;
+"""
+
+
+class PartitionCoordinator:
+    def __init__(self, config, instance_id):
+        self.config = config
+        self.instance_id = instance_id
+        self.key_prefix = config.get('key_prefix', 'threat_detector:')
+        redis_url = os.environ.get('REDIS_URL', 'redis://redis:6379/0')
+        logger.info(f"Connecting to Redis at {redis_url} for partition coordination")
+        self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
+        self.members = []
+        self.live_members = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def key(self, name):
+        return f"{self.key_prefix}{name}"
+
+    @property
+    def assignment(self):
+        return self.members.index(self.instance_id), len(self.members)
+
+    def heartbeat(self):
+        # Returns True when the set of live instances has changed since the last call. The
+        # membership key is refreshed on its own thread, so an instance whose fetching is stalled
+        # (error backoff, a full pipeline queue) does not drop out of the group.
+        if self.thread is None:
+            self.beat()
+            self.thread = threading.Thread(target=self.beat_forever, name='partition-heartbeat', daemon=True)
+            self.thread.start()
+        with self.lock:
+            members = self.live_members
+        changed = members != self.members
+        self.members = members
+        return changed
+
+    def beat(self):
+        self.redis.set(self.key(f"member:{self.instance_id}"), 1, ex=self.config.get('member_ttl', 15))
+        member_prefix = self.key('member:')
+        members = sorted(key[len(member_prefix):] for key in self.redis.scan_iter(match=f"{member_prefix}*"))
+        with self.lock:
+            self.live_members = members
+
+    def beat_forever(self):
+        while True:
+            time.sleep(self.config.get('heartbeat_interval', 5))
+            try:
+                self.beat()
+            except redis.exceptions.RedisError as e:
+                logger.error(f"Partition heartbeat failed: {str(e)}")
+
+    def rebalance_floor(self, own_millis):
+        # Every instance restarts from the oldest checkpoint in the group, so slices that move
+        # between instances are never skipped. The first instance to see a membership records
+        # the floor it saw before dropping the checkpoints of instances that have left, and the
+        # others never resume later than that floor.
+        generation = zlib.crc32(",".join(self.members).encode())
+        checkpoints = self.redis.hgetall(self.key('checkpoints'))
+        floor = min((int(millis) for millis in checkpoints.values()), default=own_millis)
+        floor_key = self.key(f"floor:{generation}")
+        if self.redis.set(floor_key, floor, nx=True, ex=max(60, self.config.get('member_ttl', 15) * 4)):
+            departed = [member for member in checkpoints if member not in self.members]
+            if departed:
+                self.redis.hdel(self.key('checkpoints'), *departed)
+        agreed = self.redis.get(floor_key)
+        return min(floor, int(agreed)) if agreed is not None else floor
+
+    def save_checkpoint(self, millis):
+        self.redis.hset(self.key('checkpoints'), self.instance_id, millis)
+
 
 class ThreatDetector:
     def __init__(self, config_path='config.yaml'):
+        self.config_path = config_path
         self.config = self.load_config(config_path)
         self.es = self.connect_to_elasticsearch()
-        self.compiled_rules = self.compile_rules()
-        self.request_timestamps = defaultdict(lambda: deque(maxlen=self.config['ddos']['max_requests']))
-        self.last_processed_timestamp = self.get_last_processed_timestamp()
+        self.init_detection_state()
+        processes = self.config.get('pipeline', {}).get('detection_processes', 0)
+        self.process_pool = DetectionProcessPool(self.config, processes) if processes else None
+        reload = self.config.get('reload', {})
+        if reload.get('enabled', True):
+            self.rule_reloader = RuleReloader(config_path, reload.get('interval', 5), self.load_detection_config)
+        else:
+            self.rule_reloader = None
+        self.instance_id = os.environ.get('DETECTOR_INSTANCE_ID', socket.gethostname())
+        partitioning = self.config.get('partitioning', {})
+        checkpoint = self.config.get('checkpoint', {})
+        checkpoint_path = checkpoint.get('path', '/mnt/logs/last_processed_timestamp.txt')
+        if partitioning.get('enabled', False):
+            self.partitions = PartitionCoordinator(partitioning, self.instance_id)
+            root, extension = os.path.splitext(checkpoint_path)
+            checkpoint_path = f"{root}.{self.instance_id}{extension}"
+        else:
+            self.partitions = None
+        self.checkpoint = Checkpoint(checkpoint_path, checkpoint.get('flush_batches', 1),
+                                     checkpoint.get('flush_interval', 0))
+        cursor = self.checkpoint.load()
+        if cursor is None:
+            cursor = (int((datetime.now(timezone.utc) - timedelta(minutes=5)).timestamp() * 1000), frozenset())
+        self.restore_cursor(cursor)
+        self.last_processed_timestamp = datetime.fromtimestamp(self.cursor_millis / 1000, timezone.utc)
+        self.pit_id = None
+        self.search_after = None
+        self.committed_cursor = self.cursor_state()
+        self.scheduler = AdaptiveScheduler(self.config['processing'])
+        self.bulk_writer = BulkWriter(self.config.get('bulk', {}))
+        self.compile_field_layout()
+
+    @classmethod
+    def for_detection(cls, config):
+        # A detector with only the detection state, used by worker processes
+        detector = cls.__new__(cls)
+        detector.config = config
+        detector.init_detection_state()
+        detector.process_pool = None
+        detector.rule_reloader = None
+        return detector
+
+    @classmethod
+    def for_replay(cls, config_path, index=None, processes=None):
+        # A detector without a checkpoint, partitioning or rule reloading. Threats go to index
+        # (the threat index by default) and normal logs are not written; DDoS windows always
+        # follow event time, since wall-clock time would put a whole range in one window.
+        detector = cls.__new__(cls)
+        detector.config_path = config_path
+        detector.config = cls.load_config(config_path)
+        detector.config['indices']['threat'] = index or detector.config['indices']['threat']
+        detector.config['indices']['normal_mode'] = 'drop'
+        detector.config['ddos']['time_source'] = 'event'
+        detector.es = detector.connect_to_elasticsearch()
+        detector.init_detection_state()
+        processes = processes or os.cpu_count() or 1
+        detector.process_pool = DetectionProcessPool(detector.config, processes) if processes > 1 else None
+        detector.rule_reloader = None
+        bulk = dict(detector.config.get('bulk', {}))
+        bulk['retry_queue'] = bulk.get('retry_queue', '/mnt/logs/bulk_retry_queue.jsonl') + '.replay'
+        bulk['dead_letter_file'] = bulk.get('dead_letter_file', '/mnt/logs/bulk_dead_letter.jsonl') + '.replay'
+        detector.bulk_writer = BulkWriter(bulk)
+        detector.compile_field_layout()
+        threat_logger.disabled = True
+        return detector
+
+    def init_detection_state(self):
+        self.rules = self.compile_detection(self.config)
+        self.log_sample_rate = self.config.get('logging', {}).get('sample_rate', 0.0)
+        self.next_profile_report = time.monotonic() + self.config.get('profiling', {}).get('report_interval', 300)
+        self.event_time = self.config['ddos'].get('time_source', 'wall') == 'event'
+        self.state_lock = threading.Lock()
+        self.late_events = 0
+        self.request_timestamps = IPStateTable(
+            lambda: SlidingWindowCounter(self.config['ddos']['time_window'], self.config['ddos']['max_requests'],
+                                         self.config['ddos'].get('allowed_lateness', 0)),
+            ttl=max(self.config['ddos'].get('state_ttl', 60), self.config['ddos']['time_window']),
+            max_entries=self.config['ddos'].get('max_tracked_ips', 100000)
+        )
+        self.counted_through = None
+        self.claim_condition = threading.Condition()
+        self.next_claim = 0
 
     @staticmethod
     def load_config(config_path):
@@ -45,37 +1187,181 @@ class ThreatDetector:
         logger.info("Successfully connected to Elasticsearch")
         return es
 
-    def get_last_processed_timestamp(self):
-        try:
-            with open('/mnt/logs/last_processed_timestamp.txt', 'r') as f:
-                return datetime.fromisoformat(f.read().strip())
-        except FileNotFoundError:
-            return datetime.now(timezone.utc) - timedelta(minutes=5)
+    @staticmethod
+    def parse_timestamp(value):
+        timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return timestamp
 
-    def save_last_processed_timestamp(self, timestamp):
-        with open('/mnt/logs/last_processed_timestamp.txt', 'w') as f:
-            f.write(timestamp.isoformat())
+    def request_time(self, log_entry):
+        if self.event_time:
+            try:
+                return self.parse_timestamp(log_entry['@timestamp']).timestamp()
+            except (KeyError, TypeError, ValueError):
+                pass
+        return time.time()
 
-    def compile_rules(self):
-        return {
-            threat_type: [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
-            for threat_type, patterns in self.config['detection_rules'].items()
-        }
+    def compile_detection(self, config):
+        started = time.perf_counter()
+        matchers = self.compile_rules(config)
+        profiling = config.get('profiling', {})
+        profiler = RuleProfiler(self.rule_entries(config), profiling.get('sample_rate', 0.01)) \
+            if profiling.get('enabled', False) else None
+        evaluation = config.get('evaluation', {})
+        max_field_length = {field if field == 'default' else detection_field(field): length
+                            for field, length in (evaluation.get('max_field_length') or {}).items()}
+        time_budget = evaluation.get('time_budget_ms')
+        rules = CompiledRules(matchers, self.compile_normalizer(config), self.create_verdict_cache(config),
+                              time.perf_counter() - started, profiler, max_field_length,
+                              time_budget / 1000 if time_budget else None)
+        logger.info(f"Compiled detection rules in {rules.compile_seconds:.3f}s: {rules.size()}")
+        return rules
+
+    @staticmethod
+    def rule_entries(config):
+        # Yields (threat_type, pattern, fields). A rule is either a pattern, which uses its threat
+        # type's detection_fields, or a mapping naming its own fields
+        field_config = config.get('detection_fields') or {}
+        for threat_type, rules in config['detection_rules'].items():
+            if threat_type == "ddos":
+                continue
+            default_fields = field_config.get(threat_type, SCAN_FIELDS)
+            for rule in rules:
+                if isinstance(rule, dict):
+                    pattern, fields = rule['pattern'], rule.get('fields', default_fields)
+                else:
+                    pattern, fields = rule, default_fields
+                yield threat_type, pattern, tuple(dict.fromkeys(detection_field(field) for field in fields))
+
+    @classmethod
+    def compile_rules(cls, config):
+        # Rules are grouped by the fields they are matched against, one matcher per group
+        groups = defaultdict(lambda: defaultdict(list))
+        for threat_type, pattern, fields in cls.rule_entries(config):
+            groups[fields][threat_type].append(pattern)
+
+        compiled_rules = []
+        for fields, rules in groups.items():
+            matcher = RuleMatcher(rules)
+            logger.info(f"Compiled {len(matcher)} detection rules over {', '.join(fields)} into "
+                        f"{len(matcher.anchor_branches)} literal anchors "
+                        f"({len(matcher.unfiltered)} branches without a required literal)")
+            compiled_rules.append((fields, matcher))
+        return compiled_rules
+
+    @staticmethod
+    def compile_normalizer(config):
+        normalization = config.get('normalization', {})
+        if not normalization.get('enabled', True):
+            return None
+        normalize = functools.partial(canonical_form, max_rounds=normalization.get('max_decode_rounds', 3))
+        cached = functools.lru_cache(maxsize=normalization.get('cache_size', 10000))(normalize)
+        max_length = normalization.get('cache_max_length', 1024)
+
+        # Only short segments are memoized; URLs and headers repeat heavily, large bodies rarely do
+        def normalize_segment(segment):
+            return cached(segment) if len(segment) <= max_length else normalize(segment)
+
+        normalize_segment.cache_info = cached.cache_info
+        return normalize_segment
+
+    @staticmethod
+    def create_verdict_cache(config):
+        # Pattern verdicts only depend on the normalised rule fields and the compiled rules, so the
+        # cache is created alongside the rules and is discarded with them
+        verdict_cache = config.get('verdict_cache', {})
+        if not verdict_cache.get('enabled', True):
+            return None
+        return VerdictCache(verdict_cache.get('ttl', 3600), verdict_cache.get('max_entries', 50000))
+
+    def load_detection_config(self):
+        config = self.load_config(self.config_path)
+        return config, self.compile_detection(config)
+
+    def apply_config(self, config, rules):
+        for section in RELOADABLE_SECTIONS:
+            if section in config:
+                self.config[section] = config[section]
+            else:
+                self.config.pop(section, None)
+        self.rules = rules
+
+    def apply_pending_rules(self):
+        pending = self.rule_reloader.take() if self.rule_reloader is not None else None
+        if pending is None:
+            return
+        config, rules = pending
+        ignored = [section for section in config
+                   if section not in RELOADABLE_SECTIONS and config[section] != self.config.get(section)]
+        self.apply_config(config, rules)
+        if self.process_pool is not None:
+            self.process_pool.reload(self.config)
+        logger.info(f"Reloaded detection rules from {self.config_path}: {rules.size()}")
+        if ignored:
+            logger.warning(f"Changes to {', '.join(ignored)} only take effect after a restart")
 
-    def detect_threats(self, log_entry):
+    @staticmethod
+    def verdict_key(segments):
+        digest = hashlib.blake2b(digest_size=16)
+        for segment in segments:
+            digest.update(f"{len(segment)}:{segment}".encode('utf-8', 'surrogatepass'))
+        return digest.digest()
+
+    @staticmethod
+    def match_rules(rules, segments):
+        # The budget is CPU time of this thread from the first rule search, so waiting on the GIL or
+        # on field extraction does not count against it. Whatever matched before the deadline is kept
+        # alongside evaluation_timeout
+        deadline = time.thread_time() + rules.time_budget if rules.time_budget else None
+        threats = set()
+        for fields, matcher in rules.matchers:
+            try:
+                threats.update(matcher.match("\n".join(segments[field] for field in fields), deadline))
+            except EvaluationTimeout as timeout:
+                threats.update(timeout.threats)
+                threats.add('evaluation_timeout')
+                break
+        return frozenset(threats)
+
+    def detect_threats(self, log_entry, rules=None, replayed=False):
+        rules = rules or self.rules
         threats = set()
         url = log_entry.get('url', '')
         method = log_entry.get('method', '')
-        request_body = json.dumps(log_entry.get('request_body', {}))
-        headers = json.dumps(log_entry.get('request_headers', {}))
         client_ip = log_entry.get('client_ip', '')
-        timestamp = datetime.now(timezone.utc)
+        timestamp = self.request_time(log_entry)
+
+        # Only the fields some rule group asks for are extracted. Each is capped before and after
+        # normalisation, since NFKC can expand the text
+        segments = {}
+        for field in rules.fields:
+            segment = field_segment(log_entry, field)
+            limit = rules.field_limits[field]
+            if limit is not None:
+                segment = segment[:limit]
+            if rules.normalize_segment is not None and segment:
+                segment = rules.normalize_segment(segment)
+                if limit is not None:
+                    segment = segment[:limit]
+            segments[field] = segment
 
-        content_to_check = f"{url} {request_body} {headers}"
+        if rules.profiler is not None and random.random() < rules.profiler.sample_rate:
+            rules.profiler.profile(segments)
 
-        for threat_type, patterns in self.compiled_rules.items():
-            if threat_type != "ddos" and any(pattern.search(content_to_check) for pattern in patterns):
-                threats.add(threat_type)
+        if rules.verdict_cache is None:
+            threats.update(self.match_rules(rules, segments))
+        else:
+            # A timeout also depends on the machine the rules ran on, not only on the content, so
+            # those verdicts are not cached
+            key = self.verdict_key(segments.values())
+            now = time.monotonic()
+            verdict = rules.verdict_cache.get(key, now)
+            if verdict is None:
+                verdict = self.match_rules(rules, segments)
+                if 'evaluation_timeout' not in verdict:
+                    rules.verdict_cache.put(key, verdict, now)
+            threats.update(verdict)
 
         if method == 'POST' and '/login' in url:
             threats.add('potential_brute_force')
@@ -84,106 +1370,621 @@ class ThreatDetector:
             threats.add('command_injection')
 
         # DDoS detection
-        self.request_timestamps[client_ip].append(timestamp)
-
-        self.request_timestamps[client_ip] = deque(
-            filter(lambda ts: timestamp - ts <= timedelta(seconds=self.config['ddos']['time_window']),
-                   self.request_timestamps[client_ip]),
-            maxlen=self.config['ddos']['max_requests']
-        )
+        with self.state_lock:
+            window = self.request_timestamps.get(client_ip, timestamp)
+            if replayed:
+                # Added before the cursor was rewound, so it is only evaluated against the window
+                request_count = window.count_at(timestamp)
+            else:
+                request_count = window.add(timestamp)
+                if request_count is None:
+                    self.late_events += 1
+                    request_count = len(window)
 
-        if len(self.request_timestamps[client_ip]) > self.config['ddos']['threshold']:
+        if request_count > self.config['ddos']['threshold']:
             threats.add('ddos')
-        elif len(self.request_timestamps[client_ip]) > 1:
+        elif request_count > 1:
             threats.add('potential_ddos')
 
         return list(threats)
 
+    def compile_field_layout(self):
+        self.field_layout = tuple(self.config['field_order'])
+        self.generate_log_id = "log_id" in self.field_layout
+        self.generate_threat_type = "threat_type" in self.field_layout
+        self.reorder_fields = self.config['processing'].get('reorder_fields', True)
+        self.field_templates = {}
+
     def reorder_log_fields(self, log_entry):
-        ordered_log = {}
-        for field in self.config['field_order']:
-            if field in log_entry:
-                ordered_log[field] = log_entry[field]
-            elif field == "log_id":
-                ordered_log[field] = str(uuid.uuid4())
-            elif field == "threat_type":
-                ordered_log[field] = log_entry.get("type", "unknown")
-
-        for key, value in log_entry.items():
-            if key not in ordered_log:
-                ordered_log[key] = value
+        missing_log_id = self.generate_log_id and "log_id" not in log_entry
+        missing_threat_type = self.generate_threat_type and "threat_type" not in log_entry
+        if missing_log_id or missing_threat_type:
+            log_entry = dict(log_entry)
+            if missing_log_id:
+                log_entry["log_id"] = str(uuid.uuid4())
+            if missing_threat_type:
+                log_entry["threat_type"] = log_entry.get("type", "unknown")
 
+        if not self.reorder_fields:
+            return log_entry if missing_log_id or missing_threat_type else dict(log_entry)
+
+        # Logs from the same source share a key shape, so the layout fields present in each shape
+        # are worked out once. Copying that template and update()-ing it puts the layout fields
+        # first and appends the rest in their original order, all without a Python-level loop.
+        shape = tuple(log_entry)
+        template = self.field_templates.get(shape)
+        if template is None:
+            if len(self.field_templates) >= 1024:
+                self.field_templates.clear()
+            template = self.field_templates[shape] = dict.fromkeys(
+                field for field in self.field_layout if field in log_entry
+            )
+        ordered_log = template.copy()
+        ordered_log.update(log_entry)
         return ordered_log
 
     def process_logs_batch(self, logs):
+        self.index_actions(self.build_actions(logs))
+
+    def detect_batch(self, log_entries, replayed=None):
+        # Reloaded rules are only swapped in here, so a batch is always detected with one rule set
+        self.apply_pending_rules()
+        replayed = replayed or [False] * len(log_entries)
+        if self.process_pool is not None:
+            return self.process_pool.detect(log_entries, replayed)
+        rules = self.rules
+        return [self.detect_threats(log_entry, rules, flag) for log_entry, flag in zip(log_entries, replayed)]
+
+    def claim_batch(self, logs, sequence=None, stop=None):
+        # Logs at or below the high-water cursor were added to the DDoS windows before the cursor
+        # was rewound (a partition rebalance or a pipeline restart), so they are flagged as replayed
+        # and not added again. Pipeline batches claim in fetch order, so the cursor only moves over
+        # batches that reached detection. Returns None if the pipeline stopped while waiting.
+        with self.claim_condition:
+            if sequence is not None:
+                while self.next_claim != sequence:
+                    if stop.is_set():
+                        return None
+                    self.claim_condition.wait(0.5)
+                self.next_claim += 1
+                self.claim_condition.notify_all()
+            if not logs:
+                return []
+            counted = self.counted_through
+            if counted is None:
+                replayed = [False] * len(logs)
+            else:
+                counted_millis, counted_ids = counted
+                replayed = [log['sort'][0] < counted_millis or
+                            (log['sort'][0] == counted_millis and log['_id'] in counted_ids) for log in logs]
+            last_millis = logs[-1]['sort'][0]
+            last_ids = frozenset(log['_id'] for log in logs if log['sort'][0] == last_millis)
+            if counted is None or last_millis > counted[0]:
+                self.counted_through = (last_millis, last_ids)
+            elif last_millis == counted[0]:
+                self.counted_through = (last_millis, counted[1] | last_ids)
+        return replayed
+
+    def detection_stats(self):
+        return {
+            "ddos": dict(self.request_timestamps.stats(), late_events=self.late_events),
+            "verdict_cache": self.rules.verdict_cache.stats() if self.rules.verdict_cache is not None else {},
+            "profile": self.rules.profiler.snapshot() if self.rules.profiler is not None else {},
+        }
+
+    def worker_totals(self, section):
+        stats = [worker[section] for worker in self.process_pool.worker_stats.values() if worker[section]]
+        return {key: sum(worker[key] for worker in stats) for key in stats[0]} if stats else {}
+
+    def ddos_stats(self):
+        if self.process_pool is not None:
+            return self.worker_totals('ddos')
+        return self.detection_stats()['ddos']
+
+    def rule_profile(self):
+        threshold = self.config.get('profiling', {}).get('slow_threshold_ms', 1.0) / 1000
+        if self.process_pool is not None:
+            snapshots = [stats['profile'] for stats in list(self.process_pool.worker_stats.values())]
+        else:
+            snapshots = [self.rules.profiler.snapshot()] if self.rules.profiler is not None else []
+        return rank_rule_profile(snapshots, threshold)
+
+    def report_rule_profile(self, force=False):
+        profiling = self.config.get('profiling', {})
+        if not profiling.get('enabled', False) or (not force and time.monotonic() < self.next_profile_report):
+            return
+        self.next_profile_report = time.monotonic() + profiling.get('report_interval', 300)
+        report = self.rule_profile()
+        report_path = profiling.get('report_path', '/mnt/logs/rule_profile.json')
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        slow = [row for row in report if row['slow']]
+        logger.info(f"Rule profile written to {report_path}; most expensive: "
+                    f"{[(row['threat_type'], row['pattern'], row['total_ms']) for row in report[:5]]}")
+        if slow:
+            logger.warning(f"{len(slow)} rules exceeded {profiling.get('slow_threshold_ms', 1.0)}ms on a single log: "
+                           f"{[(row['threat_type'], row['pattern'], row['worst_ms']) for row in slow]}")
+
+    def verdict_cache_stats(self):
+        if self.process_pool is not None:
+            stats = self.worker_totals('verdict_cache')
+        else:
+            stats = self.detection_stats()['verdict_cache']
+        return with_hit_rate(stats) if stats else {}
+
+    def build_actions(self, logs, replayed=None):
+        started = time.perf_counter()
+        if replayed is None:
+            replayed = self.claim_batch(logs)
+        normal_mode = self.config['indices'].get('normal_mode', 'index')
         actions = []
-        for log in logs:
-            threats = self.detect_threats(log['_source'])
-            reordered_log = self.reorder_log_fields(log['_source'])
+        threat_types = Counter()
+        threat_count = 0
+        for log, threats in zip(logs, self.detect_batch([log['_source'] for log in logs], replayed)):
+            sampled = self.log_sample_rate and random.random() < self.log_sample_rate
             if threats:
+                reordered_log = self.reorder_log_fields(log['_source'])
                 reordered_log['detected_threats'] = threats
                 actions.append({
                     "_index": self.config['indices']['threat'],
+                    "_id": log['_id'],
                     "_source": reordered_log
                 })
-                threat_message = f"Threat detected: {threats} in log: {reordered_log.get('url', 'N/A')} from IP: {reordered_log.get('client_ip', 'N/A')}"
-                logging.warning(threat_message)
-                threat_logger.warning(json.dumps(reordered_log))
-            else:
+                threat_count += 1
+                threat_types.update(threats)
+                if sampled:
+                    logger.warning(f"Threat detected: {threats} in log: {reordered_log.get('url', 'N/A')} from IP: {reordered_log.get('client_ip', 'N/A')}")
+                threat_logger.warning(reordered_log)
+                continue
+
+            if normal_mode == 'index':
                 actions.append({
                     "_index": self.config['indices']['normal'],
-                    "_source": reordered_log
+                    "_id": log['_id'],
+                    "_source": self.reorder_log_fields(log['_source'])
+                })
+            elif normal_mode == 'verdict':
+                # The source log stays where it is; only a reference to it and the verdict are written
+                actions.append({
+                    "_index": self.config['indices']['normal'],
+                    "_id": log['_id'],
+                    "_source": {
+                        "@timestamp": log['_source'].get('@timestamp'),
+                        "source_index": log['_index'],
+                        "source_id": log['_id'],
+                        "verdict": "normal"
+                    }
                 })
-                logging.info(
-                    f"Normal log processed: {reordered_log.get('url', 'N/A')} from IP: {reordered_log.get('client_ip', 'N/A')}")
+            if sampled:
+                logger.info(f"Normal log processed: {log['_source'].get('url', 'N/A')} from IP: {log['_source'].get('client_ip', 'N/A')}")
+        logger.info(f"Detected {threat_count} threats in {len(logs)} logs: {dict(threat_types)}")
+        STAGE_SECONDS.labels('detect').observe(time.perf_counter() - started)
+        DOCS_PROCESSED.inc(len(logs))
+        for threat_type, count in threat_types.items():
+            RULE_MATCHES.labels(threat_type).inc(count)
+        return actions
 
-        if actions:
-            try:
-                success, failed = bulk(self.es, actions)
-                logger.info(f"Indexed {success} logs. Failed: {len(failed)}")
-            except Exception as e:
-                logger.error(f"Error during bulk indexing: {str(e)}")
+    def index_actions(self, actions):
+        with STAGE_SECONDS.labels('bulk').time():
+            self.bulk_writer.drain(self.es)
+            self.bulk_writer.write(self.es, actions)
+
+    def open_point_in_time(self):
+        result = self.es.open_point_in_time(index=self.config['indices']['source'],
+                                            keep_alive=self.config['processing'].get('pit_keep_alive', '1m'))
+        self.pit_id = result['id']
+        self.search_after = None
+
+    def close_point_in_time(self):
+        if self.pit_id is None:
+            return
+        try:
+            self.es.close_point_in_time(id=self.pit_id)
+        except Exception as e:
+            logger.warning(f"Failed to close point in time: {str(e)}")
+        self.pit_id = None
+        self.search_after = None
 
     def get_new_logs(self):
+        # Pages through a point-in-time snapshot with search_after, so logs sharing a timestamp
+        # are never skipped. The snapshot stays open while pages come back full and is closed
+        # once drained; the next one resumes at the cursor and drops the ids already processed
+        # at the cursor's millisecond.
+        started = time.perf_counter()
+        self.check_partitions()
+        batch_size = self.scheduler.batch_size
         query = {
             "bool": {
                 "must": [
                     {
                         "range": {
                             "@timestamp": {
-                                "gt": self.last_processed_timestamp.isoformat()
+                                "gte": self.cursor_millis,
+                                "format": "epoch_millis"
                             }
                         }
                     }
                 ]
             }
         }
+        if self.partitions is not None and len(self.partitions.members) > 1:
+            index, count = self.partitions.assignment
+            query["bool"]["filter"] = [{
+                "script": {
+                    "script": {
+                        "source": PARTITION_SCRIPT,
+                        "params": {"field": self.config['partitioning'].get('field', 'client_ip.keyword'),
+                                   "index": index, "count": count}
+                    }
+                }
+            }]
+
+        while True:
+            if self.pit_id is None:
+                self.open_point_in_time()
+            search_args = {"search_after": self.search_after} if self.search_after else {}
+            result = self.es.search(pit={"id": self.pit_id,
+                                         "keep_alive": self.config['processing'].get('pit_keep_alive', '1m')},
+                                    query=query, sort=[{"@timestamp": "asc"}, {"_shard_doc": "asc"}],
+                                    size=batch_size, **search_args)
+            self.pit_id = result.get('pit_id', self.pit_id)
+            hits = result['hits']['hits']
+            if hits:
+                self.search_after = hits[-1]['sort']
+            if len(hits) < batch_size:
+                self.close_point_in_time()
+
+            logs = [hit for hit in hits if hit['sort'][0] != self.cursor_millis or hit['_id'] not in self.boundary_ids]
+            if logs or self.pit_id is None:
+                logging.info(f"Retrieved {len(logs)} new logs from Elasticsearch")
+                STAGE_SECONDS.labels('fetch').observe(time.perf_counter() - started)
+                DOCS_FETCHED.inc(len(logs))
+                return logs
+
+    def check_partitions(self):
+        if self.partitions is None or not self.partitions.heartbeat():
+            return
+        index, count = self.partitions.assignment
+        floor = self.partitions.rebalance_floor(self.committed_cursor[0])
+        self.close_point_in_time()
+        if floor != self.committed_cursor[0]:
+            self.restore_cursor((floor, frozenset()))
+        else:
+            self.restore_cursor(self.committed_cursor)
+        logger.info(f"Partitions rebalanced: instance {self.instance_id} owns slice {index + 1} of {count}, "
+                    f"resuming from {datetime.fromtimestamp(floor / 1000, timezone.utc).isoformat()}")
+
+    def advance_cursor(self, logs):
+        last_millis = logs[-1]['sort'][0]
+        if last_millis != self.cursor_millis:
+            self.boundary_ids = set()
+        self.boundary_ids.update(log['_id'] for log in logs if log['sort'][0] == last_millis)
+        self.cursor_millis = last_millis
+
+    def cursor_state(self):
+        return self.cursor_millis, frozenset(self.boundary_ids)
+
+    def restore_cursor(self, cursor):
+        self.cursor_millis, boundary_ids = cursor
+        self.boundary_ids = set(boundary_ids)
+
+    def commit_cursor(self, cursor):
+        # Only called once the batch is indexed. Documents are written under their source _id, so
+        # batches replayed after a crash between checkpoint flushes overwrite instead of duplicating.
+        self.committed_cursor = cursor
+        self.last_processed_timestamp = datetime.fromtimestamp(cursor[0] / 1000, timezone.utc)
+        self.checkpoint_written(self.checkpoint.save(cursor))
+
+    def flush_checkpoint(self):
+        try:
+            self.checkpoint_written(self.checkpoint.flush())
+        except OSError as e:
+            logger.error(f"Failed to write checkpoint {self.checkpoint.path}: {str(e)}")
+
+    def checkpoint_written(self, cursor):
+        if cursor is not None and self.partitions is not None:
+            self.partitions.save_checkpoint(cursor[0])
+
+    @staticmethod
+    def put_stage_item(stage_queue, item, stop):
+        while not stop.is_set():
+            try:
+                stage_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-        result = self.es.search(index=self.config['indices']['source'], query=query, sort=[{"@timestamp": "asc"}],
-                                size=self.config['processing']['batch_size'])
-        logging.info(f"Retrieved {len(result['hits']['hits'])} new logs from Elasticsearch")
-        return result['hits']['hits']
+    @staticmethod
+    def get_stage_item(stage_queue, stop):
+        while not stop.is_set():
+            try:
+                return stage_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return None
+
+    def fetch_stage(self, fetched, stop):
+        sequence = 0
+        while not stop.is_set():
+            started = time.monotonic()
+            logs = self.get_new_logs()
+            if logs:
+                self.advance_cursor(logs)
+                if not self.put_stage_item(fetched, (sequence, logs, self.cursor_state()), stop):
+                    return
+                sequence += 1
+            else:
+                logger.info("No new logs to process.")
+                self.flush_checkpoint()
+            # Time spent blocked on a full queue counts towards latency, so a slow downstream
+            # stage shrinks the batch size just like a slow fetch does
+            delay = self.scheduler.record(len(logs), self.pit_id is not None, time.monotonic() - started)
+            if delay:
+                stop.wait(delay)
+
+    def detect_stage(self, fetched, detected, stop):
+        while not stop.is_set():
+            batch = self.get_stage_item(fetched, stop)
+            if batch is None:
+                return
+            sequence, logs, cursor = batch
+            replayed = self.claim_batch(logs, sequence, stop)
+            if replayed is None:
+                return
+            if not self.put_stage_item(detected, (sequence, len(logs), self.build_actions(logs, replayed), cursor), stop):
+                return
+
+    def write_stage(self, detected, stop):
+        # Detection workers may finish out of order; batches are indexed and checkpointed in
+        # fetch order so the checkpoint never moves past a batch that has not been written
+        pending = {}
+        next_sequence = 0
+        while not stop.is_set():
+            batch = self.get_stage_item(detected, stop)
+            if batch is None:
+                return
+            pending[batch[0]] = batch
+            while next_sequence in pending:
+                _, count, actions, cursor = pending.pop(next_sequence)
+                self.index_actions(actions)
+                self.commit_cursor(cursor)
+                next_sequence += 1
+                logger.info(f"Processed {count} logs. Last processed timestamp: {self.last_processed_timestamp.isoformat()}")
+                logger.info(f"DDoS state: {self.ddos_stats()}")
+                logger.info(f"Verdict cache: {self.verdict_cache_stats()}")
+                self.report_rule_profile()
+
+    @staticmethod
+    def run_stage(stage, stop, *queues):
+        try:
+            stage(*queues, stop)
+        except Exception as e:
+            logger.error(f"Pipeline stage {threading.current_thread().name} failed: {str(e)}")
+            stop.set()
+
+    def run_pipeline(self):
+        # Fetching batch N+1 and indexing batch N-1 overlap with detecting batch N. The bounded
+        # queues between the stages apply backpressure: a stage blocks once its output is full.
+        pipeline = self.config['pipeline']
+        while True:
+            stop = threading.Event()
+            self.next_claim = 0
+            fetched = queue.Queue(maxsize=pipeline.get('queue_size', 4))
+            detected = queue.Queue(maxsize=pipeline.get('queue_size', 4))
+            stages = [threading.Thread(target=self.run_stage, args=(self.fetch_stage, stop, fetched),
+                                       name='fetcher', daemon=True)]
+            stages += [threading.Thread(target=self.run_stage, args=(self.detect_stage, stop, fetched, detected),
+                                        name=f'detector-{index}', daemon=True)
+                       for index in range(pipeline.get('detection_workers', 1))]
+            stages.append(threading.Thread(target=self.run_stage, args=(self.write_stage, stop, detected),
+                                           name='writer', daemon=True))
+            for stage in stages:
+                stage.start()
+            for stage in stages:
+                stage.join()
+
+            # A stage failed: drop whatever was in flight and resume after the last written batch
+            self.flush_checkpoint()
+            self.close_point_in_time()
+            self.restore_cursor(self.committed_cursor)
+            try:
+                logger.info("Attempting to reconnect to Elasticsearch...")
+                self.es = self.connect_to_elasticsearch()
+            except Exception as e:
+                logger.error(f"An error occurred: {str(e)}")
+            time.sleep(self.config['processing']['error_retry_interval'])
+
+    def tracked_ips(self):
+        if self.process_pool is not None:
+            return sum(stats['ddos'].get('entries', 0) for stats in list(self.process_pool.worker_stats.values()))
+        return len(self.request_timestamps)
+
+    def start_metrics_server(self):
+        metrics = self.config.get('metrics', {})
+        if not metrics.get('enabled', True):
+            return
+        # Gauges are read when scraped, so they never go stale between batches
+        CHECKPOINT_LAG.set_function(lambda: time.time() - self.last_processed_timestamp.timestamp())
+        DDOS_TRACKED_IPS.set_function(self.tracked_ips)
+        prometheus_client.start_http_server(metrics.get('port', 8000), metrics.get('address', '0.0.0.0'))
+        logger.info(f"Serving metrics on port {metrics.get('port', 8000)}")
 
     def run(self):
+        self.start_metrics_server()
+        # SIGTERM exits through SystemExit, so the cursor committed since the last flush is written here
+        try:
+            self.run_loop()
+        finally:
+            self.flush_checkpoint()
+
+    def run_loop(self):
+        if self.config.get('pipeline', {}).get('enabled', False):
+            self.run_pipeline()
+            return
+
         while True:
             try:
+                started = time.monotonic()
                 logs = self.get_new_logs()
                 if logs:
                     self.process_logs_batch(logs)
-                    last_log = logs[-1]['_source']
-                    self.last_processed_timestamp = datetime.fromisoformat(last_log['@timestamp'].replace('Z', '+00:00'))
-                    self.save_last_processed_timestamp(self.last_processed_timestamp)
+                    self.advance_cursor(logs)
+                    self.commit_cursor(self.cursor_state())
                     logger.info(f"Processed {len(logs)} logs. Last processed timestamp: {self.last_processed_timestamp.isoformat()}")
+                    logger.info(f"DDoS state: {self.ddos_stats()}")
+                    logger.info(f"Verdict cache: {self.verdict_cache_stats()}")
+                    self.report_rule_profile()
                 else:
                     logger.info("No new logs to process.")
-                time.sleep(self.config['processing']['poll_interval'])
+                    self.flush_checkpoint()
+                # An open point in time means the last page was full and more logs are waiting
+                delay = self.scheduler.record(len(logs), self.pit_id is not None, time.monotonic() - started)
+                if delay:
+                    time.sleep(delay)
             except Exception as e:
                 logger.error(f"An error occurred: {str(e)}")
+                self.flush_checkpoint()
+                self.close_point_in_time()
                 logger.info("Attempting to reconnect to Elasticsearch...")
                 self.es = self.connect_to_elasticsearch()
                 time.sleep(self.config['processing']['error_retry_interval'])
 
+    def replay_fetch_stage(self, start, end, batch_size, fetched, stop):
+        keep_alive = self.config['processing'].get('pit_keep_alive', '1m')
+        pit_id = self.es.open_point_in_time(index=self.config['indices']['source'], keep_alive=keep_alive)['id']
+        query = {"range": {"@timestamp": {"gte": start.isoformat(), "lt": end.isoformat()}}}
+        search_after = None
+        try:
+            while not stop.is_set():
+                search_args = {"search_after": search_after} if search_after else {}
+                result = self.es.search(pit={"id": pit_id, "keep_alive": keep_alive}, query=query,
+                                        sort=[{"@timestamp": "asc"}, {"_shard_doc": "asc"}],
+                                        size=batch_size, **search_args)
+                pit_id = result.get('pit_id', pit_id)
+                hits = result['hits']['hits']
+                if hits:
+                    search_after = hits[-1]['sort']
+                    if not self.put_stage_item(fetched, hits, stop):
+                        return
+                if len(hits) < batch_size:
+                    self.put_stage_item(fetched, None, stop)
+                    return
+        finally:
+            try:
+                self.es.close_point_in_time(id=pit_id)
+            except Exception as e:
+                logger.warning(f"Failed to close point in time: {str(e)}")
+
+    def replay_write_stage(self, detected, progress, stop):
+        started = time.monotonic()
+        while not stop.is_set():
+            batch = self.get_stage_item(detected, stop)
+            if batch is None:
+                return
+            count, actions = batch
+            if count is None:
+                progress['done'] = True
+                return
+            self.index_actions(actions)
+            progress['logs'] += count
+            progress['threats'] += len(actions)
+            elapsed = time.monotonic() - started
+            logger.info(f"Replayed {progress['logs']} logs, {progress['threats']} threats "
+                        f"({progress['logs'] / elapsed if elapsed else 0:.0f} docs/s)")
+
+    def replay(self, start, end, batch_size=5000):
+        # Streams [start, end) through a point-in-time snapshot. Fetching and indexing run on their
+        # own threads while this thread detects, and the live checkpoint is never read or written.
+        logger.info(f"Replaying logs from {start.isoformat()} to {end.isoformat()} into {self.config['indices']['threat']}")
+        queue_size = self.config.get('pipeline', {}).get('queue_size', 4)
+        stop = threading.Event()
+        fetched = queue.Queue(maxsize=queue_size)
+        detected = queue.Queue(maxsize=queue_size)
+        progress = {"logs": 0, "threats": 0, "done": False}
+        stages = [
+            threading.Thread(target=self.run_stage, name='replay-fetcher', daemon=True,
+                             args=(functools.partial(self.replay_fetch_stage, start, end, batch_size), stop, fetched)),
+            threading.Thread(target=self.run_stage, name='replay-writer', daemon=True,
+                             args=(functools.partial(self.replay_write_stage, detected, progress), stop)),
+        ]
+        started = time.monotonic()
+        for stage in stages:
+            stage.start()
+        try:
+            while not stop.is_set():
+                logs = self.get_stage_item(fetched, stop)
+                if logs is None:
+                    break
+                self.put_stage_item(detected, (len(logs), self.build_actions(logs)), stop)
+            self.put_stage_item(detected, (None, None), stop)
+            stages[1].join()
+        finally:
+            stop.set()
+            for stage in stages:
+                stage.join()
+
+        elapsed = time.monotonic() - started
+        if not progress['done']:
+            raise RuntimeError(f"Replay stopped after {progress['logs']} logs")
+        logger.info(f"Replay finished: {progress['logs']} logs, {progress['threats']} threats in {elapsed:.1f}s "
+                    f"({progress['logs'] / elapsed if elapsed else 0:.0f} docs/s)")
+        if self.bulk_writer.spilled or self.bulk_writer.dead_lettered:
+            logger.warning(f"{self.bulk_writer.spilled} actions are left in {self.bulk_writer.retry_queue_path} and "
+                           f"{self.bulk_writer.dead_lettered} were written to {self.bulk_writer.dead_letter_path}")
+        return progress
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Detect threats in the logs indexed in Elasticsearch")
+    parser.add_argument('--config', default='config.yaml')
+    commands = parser.add_subparsers(dest='command')
+    replay = commands.add_parser('replay', help="re-run detection over a past time range")
+    replay.add_argument('--from', dest='start', required=True, type=ThreatDetector.parse_timestamp,
+                        help="start of the range (ISO 8601, inclusive)")
+    replay.add_argument('--to', dest='end', required=True, type=ThreatDetector.parse_timestamp,
+                        help="end of the range (ISO 8601, exclusive)")
+    replay.add_argument('--index', help="index threat documents are written to (default: indices.threat)")
+    replay.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help="detection worker processes (default: one per CPU)")
+    replay.add_argument('--batch-size', type=int, default=5000)
+    profile = commands.add_parser('profile', help="time every detection rule on its own over a sample corpus")
+    profile.add_argument('--corpus', required=True, help="JSON lines file of logs or Elasticsearch hits")
+    profile.add_argument('--threshold-ms', type=float,
+                         help="flag rules slower than this on a single log (default: profiling.slow_threshold_ms)")
+    profile.add_argument('--report', help="also write the ranked report to this file")
+    return parser.parse_args(argv)
+
+
+def profile_corpus(config, corpus_path, threshold_ms=None, report_path=None):
+    profiling = dict(config.get('profiling', {}), enabled=True, sample_rate=1.0)
+    if threshold_ms is not None:
+        profiling['slow_threshold_ms'] = threshold_ms
+    config = dict(config, profiling=profiling)
+    detector = ThreatDetector.for_detection(config)
+    with open(corpus_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                log_entry = json.loads(line)
+                detector.detect_threats(log_entry.get('_source', log_entry))
+    report = detector.rule_profile()
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
 
 if __name__ == "__main__":
-    detector = ThreatDetector()
-    detector.run()
+    args = parse_args()
+    setup_logging(ThreatDetector.load_config(args.config))
+    # Exit normally on SIGTERM so buffered threat log records are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.command == 'replay':
+        detector = ThreatDetector.for_replay(args.config, args.index, args.processes)
+        detector.replay(args.start, args.end, args.batch_size)
+    elif args.command == 'profile':
+        report = profile_corpus(ThreatDetector.load_config(args.config), args.corpus, args.threshold_ms, args.report)
+        print(json.dumps(report, indent=2))
+    else:
+        detector = ThreatDetector(args.config)
+        detector.run()
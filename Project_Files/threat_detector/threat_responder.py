@@ -4,8 +4,9 @@ import yaml
 import time
 import redis
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from elasticsearch import Elasticsearch
+import prometheus_client
 import sys
 
 logging.basicConfig(level=logging.INFO,
@@ -16,6 +17,15 @@ logging.basicConfig(level=logging.INFO,
                     ])
 logger = logging.getLogger(__name__)
 
+THREATS_FETCHED = prometheus_client.Counter('threat_responder_threats_fetched_total', 'Threats fetched from the threat index')
+THREATS_PROCESSED = prometheus_client.Counter('threat_responder_threats_processed_total', 'Threats responded to')
+IPS_BLOCKED = prometheus_client.Counter('threat_responder_ips_blocked_total', 'IPs newly added to the block list')
+STAGE_SECONDS = prometheus_client.Histogram('threat_responder_stage_seconds', 'Time spent per batch in each stage',
+                                            ['stage'])
+ERRORS = prometheus_client.Counter('threat_responder_errors_total', 'Errors that interrupted the polling loop')
+CHECKPOINT_LAG = prometheus_client.Gauge('threat_responder_checkpoint_lag_seconds',
+                                         'Seconds between now and the last processed timestamp')
+
 class ThreatResponder:
     def __init__(self, config_path='responder_config.yaml'):
         logger.info("Initializing ThreatResponder")
@@ -80,14 +90,16 @@ class ThreatResponder:
         logger.info(f"Querying Elasticsearch for threats after {self.last_processed_timestamp.isoformat()}")
         logger.debug(f"Query: {json.dumps(query)}")
 
-        result = self.es.search(
-            index=self.config['indices']['threat'],
-            query=query,
-            sort=[{"@timestamp": "asc"}],
-            size=self.config['processing']['batch_size']
-        )
+        with STAGE_SECONDS.labels('fetch').time():
+            result = self.es.search(
+                index=self.config['indices']['threat'],
+                query=query,
+                sort=[{"@timestamp": "asc"}],
+                size=self.config['processing']['batch_size']
+            )
 
         threats = result['hits']['hits']
+        THREATS_FETCHED.inc(len(threats))
         logger.info(f"Retrieved {len(threats)} threats from Elasticsearch")
 
         if threats:
@@ -119,6 +131,7 @@ class ThreatResponder:
         try:
             if not self.redis.sismember(self.BLOCKED_IPS_KEY, ip):
                 self.redis.sadd(self.BLOCKED_IPS_KEY, ip)
+                IPS_BLOCKED.inc()
                 self.redis.expire(self.BLOCKED_IPS_KEY, self.config['redis']['expiration_time'])
                 logger.info(f"Blocked IP: {ip} for {self.config['redis']['expiration_time']} seconds")
             else:
@@ -145,19 +158,38 @@ class ThreatResponder:
         logger.info(f"Logged {threat_type} threat from IP: {ip}")
 
     def process_threats(self, threats):
-        for threat in threats:
-            log_entry = threat['_source']
-            detected_threats = log_entry.get('detected_threats', [])
-            client_ip = log_entry.get('client_ip')
-            if client_ip and detected_threats:
-                self.block_ip(client_ip)
+        with STAGE_SECONDS.labels('respond').time():
+            for threat in threats:
+                log_entry = threat['_source']
+                detected_threats = log_entry.get('detected_threats', [])
+                client_ip = log_entry.get('client_ip')
+                # evaluation_timeout alone only means the rules ran out of time on the request, so it
+                # is left for review rather than blocking the client
+                if client_ip and any(name != 'evaluation_timeout' for name in detected_threats):
+                    self.block_ip(client_ip)
+        THREATS_PROCESSED.inc(len(threats))
 
         if threats:
             last_threat = threats[-1]['_source']
             self.last_processed_timestamp = datetime.fromisoformat(last_threat['@timestamp'].replace('Z', '+00:00'))
             self.save_last_processed_timestamp(self.last_processed_timestamp)
 
+    def checkpoint_lag(self):
+        timestamp = self.last_processed_timestamp
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return time.time() - timestamp.timestamp()
+
+    def start_metrics_server(self):
+        metrics = self.config.get('metrics', {})
+        if not metrics.get('enabled', True):
+            return
+        CHECKPOINT_LAG.set_function(self.checkpoint_lag)
+        prometheus_client.start_http_server(metrics.get('port', 8001), metrics.get('address', '0.0.0.0'))
+        logger.info(f"Serving metrics on port {metrics.get('port', 8001)}")
+
     def run(self):
+        self.start_metrics_server()
         sync_interval = self.config.get('sync_interval', 300)  # Default to 5 minutes
         last_sync_time = time.time()
 
@@ -177,6 +209,7 @@ class ThreatResponder:
                     logger.info("No new threats to process.")
                 time.sleep(self.config['processing']['poll_interval'])
             except Exception as e:
+                ERRORS.inc()
                 logger.error(f"An error occurred: {str(e)}")
                 logger.info("Attempting to reconnect to Elasticsearch...")
                 self.es = self.connect_to_elasticsearch()